@@ -0,0 +1,100 @@
+import argparse
+import multiprocessing
+import numpy
+import time
+import run_game
+
+# Input policies by name. Each takes the session seed.
+POLICIES = {
+  'random': run_game.RandomPilot,
+  'idle': lambda seed: Idle(),
+  'autopilot': lambda seed: run_game.Autopilot(),
+}
+
+# Per-session results, in the order of the columns in the output file.
+COLUMNS = [
+  ('seed', numpy.int64),
+  ('policy', 'S16'),
+  ('ticks', numpy.int32),
+  ('paid', numpy.int32),  # Tick when the debt reached zero, or -1.
+  ('crashes', numpy.int32),
+  ('money', numpy.int32),
+  ('debt', numpy.int32),
+  ('objects_mean', numpy.float32),
+  ('objects_max', numpy.int32),
+  ('particles_max', numpy.int32),
+  ('tick_mean', numpy.float32),  # Seconds.
+  ('tick_max', numpy.float32),
+]
+
+
+class Idle(object):
+
+  def Poll(self, game):
+    return 0
+
+
+def Setup(prices):
+  run_game.PRICES.update(prices)
+
+
+def Session(job):
+  seed, policy, ticks = job
+  game = run_game.game = run_game.Game(headless=True, controls=POLICIES[policy](seed), seed=seed)
+  paid = -1
+  objects = 0
+  objects_max = 0
+  particles_max = 0
+  tick_max = 0
+  start = time.time()
+  for i in xrange(ticks):
+    t = time.time()
+    game.Tick()
+    t = time.time() - t
+    tick_max = max(tick_max, t)
+    n = len(game.objects)
+    objects += n
+    objects_max = max(objects_max, n)
+    particles_max = max(particles_max, game.particles.count)
+    if paid < 0 and game.debt <= 0:
+      paid = game.time
+  total = time.time() - start
+  return (seed, policy, game.time, paid, game.crashes, game.money, game.debt,
+          float(objects) / ticks, objects_max, particles_max, total / ticks, tick_max)
+
+
+def Batch(sessions, ticks, policies, seed=0, processes=None, prices={}):
+  jobs = [(seed + i, policies[i % len(policies)], ticks) for i in range(sessions)]
+  pool = multiprocessing.Pool(processes, Setup, (prices,))
+  try:
+    rows = pool.map(Session, jobs, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  return dict((name, numpy.array([r[i] for r in rows], dtype)) for i, (name, dtype) in enumerate(COLUMNS))
+
+
+def Price(arg):
+  name, value = arg.rsplit('=', 1)
+  if name not in run_game.PRICES:
+    raise argparse.ArgumentTypeError('no such price: %s' % name)
+  return name, int(value)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Runs many headless sessions and collects their stats.')
+  parser.add_argument('output', help='results file (.npz)')
+  parser.add_argument('--sessions', type=int, default=100)
+  parser.add_argument('--ticks', type=int, default=36000, help='length of each session')
+  parser.add_argument('--policy', action='append', choices=sorted(POLICIES), help='input policies to alternate between')
+  parser.add_argument('--seed', type=int, default=0, help='seed of the first session')
+  parser.add_argument('--processes', type=int, help='worker processes, defaults to the number of cores')
+  parser.add_argument('--price', type=Price, action='append', default=[], metavar='NAME=VALUE', help='override an entry of PRICES')
+  args = parser.parse_args()
+  t = time.time()
+  results = Batch(args.sessions, args.ticks, args.policy or ['random'], args.seed, args.processes, dict(args.price))
+  t = time.time() - t
+  numpy.savez_compressed(args.output, **results)
+  print '%d sessions, %d ticks in %.2f s (%.0f ticks/s)' % (args.sessions, args.sessions * args.ticks, t, args.sessions * args.ticks / t)
+  paid = results['paid'] >= 0
+  print '%d paid off the debt, %.1f crashes per session' % (paid.sum(), results['crashes'].mean())
@@ -0,0 +1,280 @@
+import argparse
+import ctypes
+import json
+import math
+import numpy
+import os
+import pygame
+import resource
+import subprocess
+import sys
+import time
+from OpenGL.GL import *
+import run_game
+import scenario
+from run_game import WIDTH, HEIGHT
+
+
+def Display():
+  pygame.init()
+  pygame.display.set_mode((WIDTH, HEIGHT), pygame.OPENGL | pygame.DOUBLEBUF)
+  glViewport(0, 0, WIDTH, HEIGHT)
+  glMatrixMode(GL_PROJECTION)
+  glLoadIdentity()
+  glScale(2./WIDTH, 2./HEIGHT, 1)
+  glMatrixMode(GL_MODELVIEW)
+  glLoadIdentity()
+
+
+def Offscreen():
+  # Renders into an EGL pbuffer instead of a window, so the scenarios run on
+  # machines without a display. PyOpenGL has to be on its EGL platform before
+  # it is first imported, which Suite does through the environment.
+  from OpenGL import EGL
+  display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+  major, minor = EGL.EGLint(), EGL.EGLint()
+  if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+    raise RuntimeError('no EGL display')
+  attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8, EGL.EGL_NONE]
+  config = EGL.EGLConfig()
+  count = EGL.EGLint()
+  if not EGL.eglChooseConfig(display, (EGL.EGLint * len(attributes))(*attributes), ctypes.pointer(config), 1, ctypes.pointer(count)) or not count.value:
+    raise RuntimeError('no EGL config for OpenGL')
+  size = [EGL.EGL_WIDTH, WIDTH, EGL.EGL_HEIGHT, HEIGHT, EGL.EGL_NONE]
+  surface = EGL.eglCreatePbufferSurface(display, config, (EGL.EGLint * len(size))(*size))
+  EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+  context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+  if not EGL.eglMakeCurrent(display, surface, surface, context):
+    raise RuntimeError('cannot make the EGL context current')
+  # There is no window to open or to swap.
+  for f in 'set_mode', 'set_caption', 'gl_set_attribute', 'flip':
+    setattr(pygame.display, f, lambda *args, **kwargs: None)
+
+
+def Immediate(particles):
+  # The per-particle path the game used before batching.
+  n = particles.count
+  for r, phi, age in zip(particles.r[:n], particles.phi[:n], particles.age[:n]):
+    with run_game.Transform():
+      glRotate(phi, 0, 0, 1)
+      glTranslate(r, 0, 0)
+      with run_game.Texture(particles.light):
+        with run_game.Blending(GL_ONE, GL_ONE):
+          f = 100.0 / (100 + age)
+          with run_game.Color(f, f * f, f * f * f):
+            run_game.Quad(200 * f, 200 * f)
+
+
+def Batched(particles):
+  particles.Render()
+  run_game.game.queue.Flush()
+
+
+def Timed(f, frames):
+  glFinish()
+  t = time.time()
+  for i in range(frames):
+    glClear(GL_COLOR_BUFFER_BIT)
+    f()
+    glFinish()
+  return (time.time() - t) / frames * 1000
+
+
+def Sprites(counts=(1000, 10000, 50000), frames=10):
+  Display()
+  run_game.game = run_game.Game(headless=True)
+  for n in counts:
+    particles = run_game.ParticleSystem(n)
+    particles.budget = 4 * n  # Room for all of them without merging.
+    particles.Emit(numpy.random.uniform(0, 400, n), numpy.random.uniform(0, 360, n), 0, 0)
+    Batched(particles)  # Creates the texture.
+    batched = Timed(lambda: Batched(particles), frames)
+    immediate = Timed(lambda: Immediate(particles), max(1, frames * 1000 / n))
+    print '%6d sprites: batched %8.2f ms, immediate %8.2f ms (%.0fx)' % (n, batched, immediate, immediate / batched)
+    sys.stdout.flush()
+
+
+# Scripted pilots for the scenarios. They only look at the game, so every run
+# of a scenario plays out the same way.
+class Hover(object):
+
+  def __init__(self, altitude=330):
+    self.altitude = altitude
+
+  def Keys(self, game):
+    taxi = game.taxi
+    return run_game.UP if taxi.vr < 0 and taxi.r < self.altitude else 0
+
+  def Poll(self, game):
+    return self.Keys(game)
+
+
+class Thrust(Hover):
+
+  def Poll(self, game):
+    side = run_game.LEFT if game.time // 60 % 2 else run_game.RIGHT
+    return self.Keys(game) | side | (run_game.DOWN if game.time % 7 == 0 else 0)
+
+
+class Bomber(Hover):
+
+  def Poll(self, game):
+    game.taxi.bombs = 1
+    return self.Keys(game) | (run_game.BOMB if game.time % 15 == 0 else 0)
+
+
+def Empty(game):
+  game.controls = Hover()
+
+
+def City(game, buildings=40):
+  game.controls = Hover(400)
+  for i in range(buildings):
+    game.Place(run_game.Building)
+    game.Run(20)
+
+
+def Metropolis(game):
+  scenario.Populate(game)
+  game.controls = Hover(game.taxi.r)
+
+
+def Thrusting(game):
+  game.controls = Thrust()
+
+
+def Bombs(game):
+  game.controls = Bomber()
+
+
+def Churn(game):
+  # New numbers on the HUD every tick.
+  game.controls = Hover()
+  game.Every(lambda: game.GiveMoney(7 if game.time % 2 else -6), 1)
+
+
+SCENARIOS = [
+  ('empty', Empty),
+  ('city', City),
+  ('metropolis', Metropolis),
+  ('thrust', Thrusting),
+  ('bombs', Bombs),
+  ('hud', Churn),
+]
+
+
+def Percentiles(samples):
+  return [round(p, 3) for p in numpy.percentile(samples, [50, 95, 99])]
+
+
+def Scenario(name, ticks, load=None):
+  # One frame per tick, each waiting for the GPU to finish. A saved game, like
+  # one from scenario.py, can stand in for the new one.
+  game = run_game.Load(load) if load else run_game.Game(seed=1)
+  run_game.game = game
+  game.OpenWindow()
+  dict(SCENARIOS)[name](game)
+  game.profiler = run_game.Profiler(window=ticks)
+  times = dict((k, []) for k in ('update', 'render', 'frame'))
+  objects = particles = 0
+  for i in range(ticks):
+    t0 = time.time()
+    game.Tick()
+    t1 = time.time()
+    game.Render()
+    glFinish()
+    t2 = time.time()
+    pygame.display.flip()
+    t3 = time.time()
+    game.profiler.EndFrame()
+    times['update'].append(1000 * (t1 - t0))
+    times['render'].append(1000 * (t2 - t1))
+    times['frame'].append(1000 * (t3 - t0))
+    objects = max(objects, len(game.objects))
+    particles = max(particles, game.particles.count)
+  pygame.quit()
+  profiler = game.profiler
+  return {
+    'ticks': ticks,
+    'ms': dict((k, Percentiles(v)) for k, v in times.iteritems()),
+    'sections': dict((k, [round(p, 3) for p in v]) for k, v in profiler.Percentiles().iteritems()),
+    'counts': dict((k, Percentiles(v)) for k, v in profiler.counters.iteritems()),
+    'peak_objects': objects,
+    'peak_particles': particles,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  }
+
+
+def Suite(names, ticks, software=False, load=None):
+  # Each scenario runs in a fresh process, so the memory high-water marks
+  # are separate.
+  env = dict(os.environ)
+  env.setdefault('SDL_AUDIODRIVER', 'dummy')
+  extra = []
+  if software:
+    env['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    env['PYOPENGL_PLATFORM'] = 'egl'
+    env['EGL_PLATFORM'] = 'surfaceless'
+    env['SDL_VIDEODRIVER'] = 'dummy'
+    extra.append('--software')
+  if load:
+    extra += ['--load', load]
+  results = {}
+  for name in names:
+    out = subprocess.check_output([sys.executable, __file__, '--scenario', name, '--ticks', str(ticks)] + extra, env=env)
+    results[name] = json.loads(out.splitlines()[-1])
+    print >>sys.stderr, '%-10s frame p50 %7.2f ms, p99 %7.2f ms' % (name, results[name]['ms']['frame'][0], results[name]['ms']['frame'][2])
+  return results
+
+
+def Compare(results, baseline, tolerance):
+  # Lines for the frame-time percentiles that got slower than the tolerance.
+  regressions = []
+  for name, result in sorted(results.iteritems()):
+    if name not in baseline:
+      continue
+    for k in 'update', 'render', 'frame':
+      for p, new, old in zip((50, 95, 99), result['ms'][k], baseline[name]['ms'][k]):
+        if new > old * (1 + tolerance):
+          regressions.append('%s %s p%d: %.2f ms -> %.2f ms (+%.0f%%)' % (name, k, p, old, new, 100 * (new / old - 1)))
+  return regressions
+
+
+if __name__ == '__main__':
+  names = [name for name, setup in SCENARIOS]
+  parser = argparse.ArgumentParser(description='Satellite Taxi benchmarks')
+  parser.add_argument('scenarios', nargs='*', help='scenarios to run: %s (default: all)' % ', '.join(names))
+  parser.add_argument('--ticks', type=int, default=1200, help='ticks to run each scenario for')
+  parser.add_argument('--output', metavar='FILE', help='write the results here as JSON')
+  parser.add_argument('--baseline', metavar='FILE', help='compare against these results, exit with 1 on regressions')
+  parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+  parser.add_argument('--software', action='store_true', help='render offscreen with the Mesa software renderer, for machines without a GPU or a display')
+  parser.add_argument('--load', metavar='FILE', help='start every scenario from this saved game')
+  parser.add_argument('--sprites', action='store_true', help='compare batched and immediate sprite drawing instead')
+  parser.add_argument('--scenario', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  for name in args.scenarios:
+    if name not in names:
+      parser.error('unknown scenario: %s' % name)
+  if args.sprites:
+    Sprites()
+  elif args.scenario:
+    if args.software:
+      Offscreen()
+    print json.dumps(Scenario(args.scenario, args.ticks, args.load))
+  else:
+    results = Suite(args.scenarios or names, args.ticks, args.software, args.load)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+      with open(args.output, 'w') as f:
+        f.write(text + '\n')
+    else:
+      print text
+    if args.baseline:
+      with open(args.baseline) as f:
+        regressions = Compare(results, json.load(f), args.tolerance)
+      for line in regressions:
+        print >>sys.stderr, 'regression:', line
+      if regressions:
+        sys.exit(1)
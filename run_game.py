@@ -1,10 +1,26 @@
-import ctypes
+import argparse
+import collections
 import contextlib
+import copy_reg
+import cPickle
+import ctypes
+import functools
+import heapq
+import itertools
+import json
 import math
+import multiprocessing.pool
+import numpy
 import os
+import Queue
 import pygame
 import random
+import struct
 import sys
+import threading
+import time
+import types
+import zlib
 from OpenGL.GL import *
 
 WIDTH, HEIGHT = 800, 600
@@ -19,6 +35,21 @@ PRICES = {
 
 SHOPPING_TIME = 120
 
+# Motion around the Moon, per tick.
+GRAVITY = 0.02
+DRAG = 0.99
+# How far ahead the ballistic path of the taxi is predicted.
+PREVIEW_TICKS = 600
+
+# The simulation always advances in steps of this many seconds, whatever the
+# frame rate. A slow frame is caught up with at most MAX_TICKS steps.
+TICK = 1.0 / 60
+MAX_TICKS = 5
+
+# Resolutions of the background buffer, relative to the window. The collision
+# surface always stays at 2x, so the simulation does not depend on this.
+BUFFER_SCALES = 0.5, 0.75, 1, 1.5, 2, 3, 4
+
 SOUNDS = {
   'crash': 'crash.ogg',
   'pickup': 'pickup.ogg',
@@ -29,84 +60,276 @@ SOUNDS = {
   'win': 'win.ogg',
 }
 
+# When the channels run out, a sound can cut off one with a lower priority.
+PRIORITY = {
+  'crash': 1,
+  'buy': 2,
+  'pickup': 3,
+  'thanks': 3,
+  'shield-down': 4,
+  'win': 5,
+}
+LOOPING = ['engine']
+
 MUSIC = ['space-rock.ogg', 'space-rave.ogg', 'space-waltz.ogg']
 
+# Saves are written this often, if autosave is on.
+AUTOSAVE_TICKS = 60 * 60
+
+# Input state for one tick, as a bit mask.
+LEFT, RIGHT, UP, DOWN, BOMB, QUIT = 1, 2, 4, 8, 16, 32
+THRUST = LEFT | RIGHT | UP | DOWN
+
 
-def Light(radius, height, strength):
-  r2 = float(radius * radius)
-  h2 = float(height * height)
-  data = ''
-  fn = 'light-%s-%s-%s.data' % (radius, height, strength)
+LIGHT_VERSION = 2
+LIGHTS = {}
+PARTICLE_LIGHT = 20, 100, 5
+TAXI_LIGHT = 20, 100, 50
+# Most particles alive at once, unless the frame time calls for fewer.
+PARTICLE_BUDGET = 20000
+
+# Render queue layers, back to front.
+BACKGROUND, GLOW, SHAPES, TEXT = range(4)
+# Blend modes, in the order they are drawn within a layer.
+OPAQUE, DARKEN, ADD = range(3)
+BLEND_FUNCS = {DARKEN: (GL_ZERO, GL_ONE_MINUS_SRC_COLOR), ADD: (GL_ONE, GL_ONE)}
+
+
+def LightData(radius, height, strength):
+  fn = 'light-%s-%s-%s-v%d.npy' % (radius, height, strength, LIGHT_VERSION)
   if os.path.exists(fn):
-    with file(fn) as f:
-      data = f.read()
-  if len(data) != 3 * 1024 * 1024:
-    print 'Generating', fn, 'on first run...'
-    data = (ctypes.c_char * (3 * 1024 * 1024))()
-    i = 0
-    for x in range(1024):
-      x -= 512
-      for y in range(1024):
-        y -= 512
-        d2 = h2 + x * x + y * y
-        e2 = d2 - r2
-        alpha = math.atan(math.sqrt(r2 / e2)) * 2 / math.pi
-        c = chr(max(0, min(255, int(strength * 255 * alpha * alpha))))
-        data[i * 3] = c
-        data[i * 3 + 1] = c
-        data[i * 3 + 2] = c
-        i += 1
-    with file(fn, 'wb') as f:
-      f.write(data)
-  tex = glGenTextures(1)
-  glBindTexture(GL_TEXTURE_2D, tex)
-  glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-  glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-  glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
-  glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
-  glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_FALSE)
-  glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, 1024, 1024, 0, GL_RGB, GL_UNSIGNED_BYTE, data)
-  return tex
+    try:
+      data = numpy.load(fn, mmap_mode='r')
+      if data.shape == (1024, 1024) and data.dtype == numpy.uint8:
+        return data
+    except (IOError, ValueError):
+      pass
+  print 'Generating', fn, 'on first run...'
+  x, y = numpy.ogrid[-512:512, -512:512]
+  e2 = float(height * height) + x * x + y * y - float(radius * radius)
+  alpha = numpy.arctan(numpy.sqrt(radius * radius / e2)) * 2 / math.pi
+  data = numpy.clip(strength * 255 * alpha * alpha, 0, 255).astype(numpy.uint8)
+  numpy.save(fn, data)
+  return data
+
+
+def Light(radius, height, strength, data=None):
+  key = radius, height, strength
+  if key not in LIGHTS:
+    data = numpy.ascontiguousarray(LightData(*key) if data is None else data)
+    tex = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, tex)
+    glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+    glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+    glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_FALSE)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, 1024, 1024, 0, GL_LUMINANCE, GL_UNSIGNED_BYTE, data)
+    LIGHTS[key] = tex
+  return LIGHTS[key]
+
+
+# A static vertex array, uploaded to a VBO the first time it is drawn.
+class Shape(object):
+
+  def __init__(self, mode, vertices, uvs=None):
+    self.mode = mode
+    self.count = len(vertices)
+    self.textured = uvs is not None
+    self.data = numpy.ascontiguousarray(numpy.hstack([vertices, uvs]) if self.textured else vertices, numpy.float32)
+    self.vbo = None
+
+  def Draw(self):
+    if self.vbo is None:
+      self.vbo = glGenBuffers(1)
+      glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+      glBufferData(GL_ARRAY_BUFFER, self.data, GL_STATIC_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    stride = self.data.shape[1] * 4
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(2, GL_FLOAT, stride, ctypes.c_void_p(0))
+    if self.textured:
+      glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+      glTexCoordPointer(2, GL_FLOAT, stride, ctypes.c_void_p(8))
+    glDrawArrays(self.mode, 0, self.count)
+    if self.textured:
+      glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+GEOMETRY = {}
+
+
+def Outline(radius):
+  a = numpy.linspace(0, math.pi * 2, radius * 5 + 1)
+  return numpy.column_stack([radius * numpy.cos(a), radius * numpy.sin(a)])
+
+
+def Geometry(mode, radius):
+  # Circles are triangle fans, rings are dashed lines.
+  key = mode, radius
+  if key not in GEOMETRY:
+    outline = Outline(radius)
+    if mode == GL_TRIANGLE_FAN:
+      GEOMETRY[key] = Shape(mode, numpy.vstack([[(0, 0)], outline]))
+    elif mode == GL_LINES:
+      GEOMETRY[key] = Shape(mode, outline)
+    elif mode == GL_TRIANGLES:
+      # The fan unrolled, so that many copies can go in one draw call.
+      triangles = numpy.zeros((len(outline) - 1, 3, 2), numpy.float32)
+      triangles[:, 1] = outline[:-1]
+      triangles[:, 2] = outline[1:]
+      GEOMETRY[key] = triangles
+  return GEOMETRY[key]
 
 
 def Circle(radius):
-  glBegin(GL_TRIANGLE_FAN)
-  glVertex2d(0, 0)
-  segments = radius * 5
-  for i in range(segments + 1):
-    glVertex2d(radius * math.cos(math.pi * 2 * i / segments), radius * math.sin(math.pi * 2 * i / segments))
-  glEnd()
+  Geometry(GL_TRIANGLE_FAN, radius).Draw()
 
 
-def Ring(radius):
-  glBegin(GL_LINES)
-  segments = radius * 5
-  for i in range(segments + 1):
-    glVertex2d(radius * math.cos(math.pi * 2 * i / segments), radius * math.sin(math.pi * 2 * i / segments))
-  glEnd()
+UNIT_QUAD = Shape(GL_TRIANGLE_STRIP, [(-0.5, -0.5), (0.5, -0.5), (-0.5, 0.5), (0.5, 0.5)], [(0, 0), (1, 0), (0, 1), (1, 1)])
 
 
 def Quad(width, height):
-  glBegin(GL_TRIANGLE_STRIP)
-  glTexCoord2d(0, 0)
-  glVertex2d(-0.5 * width, -0.5 * height)
-  glTexCoord2d(1, 0)
-  glVertex2d(0.5 * width, -0.5 * height)
-  glTexCoord2d(0, 1)
-  glVertex2d(-0.5 * width, 0.5 * height)
-  glTexCoord2d(1, 1)
-  glVertex2d(0.5 * width, 0.5 * height)
-  glEnd()
+  glPushMatrix()
+  glScale(width, height, 1)
+  UNIT_QUAD.Draw()
+  glPopMatrix()
 
 
 def Length(x, y):
   return math.sqrt(x * x + y * y)
 
 
+def Lerp(last, current):
+  # The state to render, between the last two ticks.
+  return last + (current - last) * game.alpha
+
+
+QUAD = numpy.array([(-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)], numpy.float32)
+QUAD_UV = QUAD + 0.5
+
+
+def Rect(width, height, x=0, y=0):
+  return QUAD * (width, height) + (x, y)
+
+
+def Disc(radius):
+  return Geometry(GL_TRIANGLES, radius).reshape(-1, 2)
+
+
+def RingLines(radius):
+  # An even number of vertices, so that rings can share a draw call.
+  lines = Geometry(GL_LINES, radius).data
+  return lines[:len(lines) // 2 * 2]
+
+
+def Place(xy, x, y, angle=0, scale=1):
+  # Scales and rotates (in degrees) around the origin, then moves to x, y.
+  a = angle * math.pi / 180
+  c = math.cos(a) * scale
+  s = math.sin(a) * scale
+  return numpy.dot(xy, [[c, s], [-s, c]]) + (x, y)
+
+
+def Vertices(xy, color, uv=None):
+  # Interleaved position, texture coordinates and color for the RenderQueue.
+  data = numpy.zeros((len(xy), 7), numpy.float32)
+  data[:, 0:2] = xy
+  if uv is not None:
+    data[:, 2:4] = uv
+  data[:, 4:7] = color
+  return data
+
+
+def Sprites(x, y, size, color):
+  # Axis-aligned textured quads. These are not rotated, so this is only for
+  # radially symmetric textures.
+  n = len(x)
+  data = numpy.empty((n, 4, 7), numpy.float32)
+  data[:, :, 0] = x[:, numpy.newaxis] + QUAD[:, 0] * size[:, numpy.newaxis]
+  data[:, :, 1] = y[:, numpy.newaxis] + QUAD[:, 1] * size[:, numpy.newaxis]
+  data[:, :, 2:4] = QUAD_UV
+  data[:, :, 4:7] = color[:, numpy.newaxis, :]
+  return data.reshape(4 * n, 7)
+
+
+# Collects the draw commands of a frame, in world coordinates. Flush sorts them
+# by layer, blend mode and texture, uploads all vertices in one buffer and
+# draws each run of commands with the same state and primitive in one call.
+# The sort is stable, so commands with the same state are drawn in the order
+# they were submitted. State is only changed between calls that need
+# different state.
+class RenderQueue(object):
+
+  def __init__(self):
+    self.commands = []
+    self.vbo = None
+    self.draws = 0
+    self.changes = 0
+
+  def Submit(self, data, mode=GL_TRIANGLES, texture=0, blend=OPAQUE, layer=SHAPES):
+    self.commands.append(((layer, blend, texture, mode), data))
+
+  def Flush(self):
+    self.draws = self.changes = 0
+    if not self.commands:
+      return
+    self.commands.sort(key=lambda c: c[0][:3])
+    if self.vbo is None:
+      self.vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    glBufferData(GL_ARRAY_BUFFER, numpy.concatenate([data for key, data in self.commands]), GL_STREAM_DRAW)
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+    glEnableClientState(GL_COLOR_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 28, ctypes.c_void_p(0))
+    glTexCoordPointer(2, GL_FLOAT, 28, ctypes.c_void_p(8))
+    glColorPointer(3, GL_FLOAT, 28, ctypes.c_void_p(16))
+    texture = 0
+    blend = OPAQUE
+    first = 0
+    for (layer, b, t, mode), commands in itertools.groupby(self.commands, lambda c: c[0]):
+      if t != texture:
+        if not t:
+          glDisable(GL_TEXTURE_2D)
+        else:
+          if not texture:
+            glEnable(GL_TEXTURE_2D)
+          glBindTexture(GL_TEXTURE_2D, t)
+        texture = t
+        self.changes += 1
+      if b != blend:
+        if b == OPAQUE:
+          glDisable(GL_BLEND)
+        else:
+          if blend == OPAQUE:
+            glEnable(GL_BLEND)
+          glBlendFunc(*BLEND_FUNCS[b])
+        blend = b
+        self.changes += 1
+      count = sum(len(data) for key, data in commands)
+      glDrawArrays(mode, first, count)
+      first += count
+      self.draws += 1
+    if texture:
+      glDisable(GL_TEXTURE_2D)
+    if blend != OPAQUE:
+      glDisable(GL_BLEND)
+    glDisableClientState(GL_COLOR_ARRAY)
+    glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    glColor(1, 1, 1, 1)
+    self.commands = []
+
+
 @contextlib.contextmanager
 def Buffer(buf):
   glBindFramebuffer(GL_FRAMEBUFFER, buf)
-  glViewport(0, 0, WIDTH * 2, HEIGHT * 2)
+  glViewport(0, 0, int(WIDTH * game.buffer_scale), int(HEIGHT * game.buffer_scale))
   yield
   glBindFramebuffer(GL_FRAMEBUFFER, 0)
   glViewport(0, 0, WIDTH, HEIGHT)
@@ -142,132 +365,355 @@ def Color(*rgba):
   glColor(1, 1, 1, 1)
 
 
-def ReadPixels(buf, x, y, w, h):
-  glBindFramebuffer(GL_FRAMEBUFFER, buf)
-  p = glReadPixels(x, y, w, h, GL_RED, GL_UNSIGNED_BYTE)
-  glBindFramebuffer(GL_FRAMEBUFFER, 0)
-  return p
-
+# CPU copy of the red channel of the background buffer. Everything drawn into
+# the background is also stamped here, so collisions need no GPU readback.
+class Surface(object):
 
-class Particle(object):
+  def __init__(self):
+    self.scale = 2
+    self.width = WIDTH * self.scale
+    self.height = HEIGHT * self.scale
+    self.grid = numpy.zeros((self.height, self.width), numpy.uint8)
+    self.frontier = Frontier(self)
+    # Counts the changes, for caches that depend on the contents.
+    self.version = 0
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['grid'] = self.grid.tostring()
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.grid = numpy.fromstring(self.grid, numpy.uint8).reshape(self.height, self.width)
+
+  def Image(self, width, height):
+    # The RGB contents of the background buffer, at any resolution.
+    palette = numpy.repeat(numpy.arange(256, dtype=numpy.uint8)[:, numpy.newaxis], 3, 1)
+    for color in SHOPS:
+      palette[color[0]] = color
+    grid = self.grid
+    if grid.shape != (height, width):
+      rows = numpy.arange(height) * self.height // height
+      cols = numpy.arange(width) * self.width // width
+      grid = grid[rows[:, numpy.newaxis], cols]
+    return palette[grid]
+
+  def Region(self, left, bottom, right, top):
+    s = self.scale
+    i0 = max(0, int((bottom + HEIGHT / 2) * s))
+    i1 = min(self.height, int(math.ceil((top + HEIGHT / 2) * s)))
+    j0 = max(0, int((left + WIDTH / 2) * s))
+    j1 = min(self.width, int(math.ceil((right + WIDTH / 2) * s)))
+    x = (numpy.arange(j0, j1) + 0.5) / s - WIDTH / 2
+    y = (numpy.arange(i0, i1) + 0.5) / s - HEIGHT / 2
+    return self.grid[i0:max(i0, i1), j0:max(j0, j1)], x[numpy.newaxis, :], y[:, numpy.newaxis]
+
+  def Circle(self, x, y, radius, value):
+    grid, px, py = self.Region(x - radius, y - radius, x + radius, y + radius)
+    grid[(px - x) ** 2 + (py - y) ** 2 <= radius * radius] = value
+    self.Changed(x - radius, y - radius, x + radius, y + radius)
+
+  def Quad(self, x, y, angle, width, height, value):
+    a = angle * math.pi / 180
+    c, s = math.cos(a), math.sin(a)
+    ex = 0.5 * (abs(c * width) + abs(s * height))
+    ey = 0.5 * (abs(s * width) + abs(c * height))
+    grid, px, py = self.Region(x - ex, y - ey, x + ex, y + ey)
+    dx = px - x
+    dy = py - y
+    inside = (abs(c * dx + s * dy) <= 0.5 * width) & (abs(c * dy - s * dx) <= 0.5 * height)
+    grid[inside] = value
+    self.Changed(x - ex, y - ey, x + ex, y + ey)
+
+  def Text(self, font, x, y, text, value):
+    coverage = font.Mask(text)
+    h, w = coverage.shape
+    grid, px, py = self.Region(x - 0.5 * w, y - 0.5 * h, x + 0.5 * w, y + 0.5 * h)
+    cx = numpy.clip(numpy.floor(px - x + 0.5 * w).astype(int), 0, w - 1)
+    cy = numpy.clip(numpy.floor(py - y + 0.5 * h).astype(int), 0, h - 1)
+    g = coverage[cy, cx] / 255.
+    grid[...] = grid * (1 - g) + value * g + 0.5
+    self.Changed(x - 0.5 * w, y - 0.5 * h, x + 0.5 * w, y + 0.5 * h)
+
+  def Box(self, x, y, size):
+    n = int(size * self.scale)
+    i = int((y + HEIGHT / 2) * self.scale - n / 2)
+    j = int((x + WIDTH / 2) * self.scale - n / 2)
+    return self.grid[max(0, i):max(0, i + n), max(0, j):max(0, j + n)]
+
+  def Changed(self, left, bottom, right, top):
+    self.version += 1
+    self.frontier.Update(left, bottom, right, top)
+
+  def Touches(self, x, y, size, value):
+    return (self.Box(x, y, size) == value).any()
+
+  def Solid(self, x, y, size):
+    return self.Box(x, y, size).any()
+
+  def Indices(self, x, y):
+    # Positions in the flattened grid, and whether they are on it at all.
+    i = numpy.floor((y + HEIGHT / 2) * self.scale).astype(int)
+    j = numpy.floor((x + WIDTH / 2) * self.scale).astype(int)
+    inside = (0 <= i) & (i < self.height) & (0 <= j) & (j < self.width)
+    return numpy.where(inside, i * self.width + j, 0), inside
+
+  def Values(self, x, y):
+    index, inside = self.Indices(x, y)
+    values = self.grid.ravel()[index]
+    values[~inside] = 0
+    return values
+
+
+# Lattice points on the surface that have free space radially outward. These
+# are the spots where Place can put things. Kept up to date as the surface
+# changes, so picking one is O(1).
+class Frontier(object):
+  step = 10
+  lift = 10
+
+  def __init__(self, surface):
+    self.surface = surface
+    self.x = numpy.arange(0, WIDTH, self.step) - WIDTH / 2
+    self.y = numpy.arange(0, HEIGHT, self.step) - HEIGHT / 2
+    self.member = numpy.zeros((len(self.y), len(self.x)), bool)
+    self.cells = []
+    self.slots = {}
+
+  def Update(self, left, bottom, right, top):
+    # Points up to "lift" away can look into the changed area.
+    m = self.lift + self.step
+    j0, j1 = numpy.searchsorted(self.x, [left - m, right + m])
+    i0, i1 = numpy.searchsorted(self.y, [bottom - m, top + m])
+    if i0 == i1 or j0 == j1:
+      return
+    x, y = numpy.meshgrid(self.x[j0:j1], self.y[i0:i1])
+    phi = numpy.arctan2(y, x)
+    r = numpy.hypot(x, y) + self.lift
+    full = self.surface.Values(x, y) != 0
+    free = self.surface.Values(r * numpy.cos(phi), r * numpy.sin(phi)) == 0
+    edge = full & free
+    changed = numpy.argwhere(edge != self.member[i0:i1, j0:j1])
+    self.member[i0:i1, j0:j1] = edge
+    for i, j in changed:
+      cell = int(i + i0), int(j + j0)
+      if edge[i, j]:
+        self.slots[cell] = len(self.cells)
+        self.cells.append(cell)
+      else:
+        # Swap-remove.
+        k = self.slots.pop(cell)
+        last = self.cells.pop()
+        if last != cell:
+          self.cells[k] = last
+          self.slots[last] = k
+
+  def Pick(self, x, y, exclusion):
+    # A random frontier point at least "exclusion" away from (x, y).
+    for attempt in range(10):
+      if not self.cells:
+        return None
+      i, j = random.choice(self.cells)
+      if Length(self.x[j] - x, self.y[i] - y) >= exclusion:
+        return self.x[j], self.y[i]
+    cells = [(i, j) for i, j in self.cells if Length(self.x[j] - x, self.y[i] - y) >= exclusion]
+    if cells:
+      i, j = random.choice(cells)
+      return self.x[j], self.y[i]
+    return None
+
+
+def Step(r, phi, vr, vphi):
+  # One tick of free fall. Works on numbers and on arrays of bodies alike.
+  vr = (vr - GRAVITY) * DRAG
+  vphi = vphi * DRAG
+  return r + vr, phi + vphi, vr, vphi
+
+
+def Trajectory(r, phi, vr, vphi, ticks):
+  # The positions after 1 to ticks Steps, all at once. The velocities decay
+  # geometrically towards the terminal velocity, so the positions are their
+  # running sums.
+  terminal = -GRAVITY * DRAG / (1 - DRAG)
+  decay = DRAG ** numpy.arange(1, ticks + 1)
+  return r + numpy.cumsum((vr - terminal) * decay + terminal), phi + numpy.cumsum(vphi * decay)
+
+
+# Visual only, so it has its own random generator and its budget can follow
+# the frame time without changing the game. When the budget is tight, new
+# particles are merged into fewer, larger ones, and the oldest are culled.
+class ParticleSystem(object):
   light = None
-
-  def __init__(self, r, phi, vr, vphi):
-    if Particle.light is None:
-      Particle.light = Light(20, 100, 5)
-    self.r = r
-    self.phi = phi
-    self.vr = vr
-    self.vphi = vphi
-    self.age = int(random.expovariate(1/50.))
+  fields = 'r', 'phi', 'vr', 'vphi', 'age', 'last_r', 'last_phi', 'weight'
+
+  def __init__(self, capacity=1024, seed=None):
+    self.count = 0
+    self.budget = PARTICLE_BUDGET
+    self.phase = 0
+    self.drawn = 0
+    self.random = numpy.random.RandomState(seed)
+    self.Allocate(capacity)
+
+  def Allocate(self, capacity):
+    for k in self.fields:
+      a = numpy.zeros(capacity, numpy.int32 if k == 'age' else numpy.float64)
+      if self.count:
+        a[:self.count] = getattr(self, k)[:self.count]
+      setattr(self, k, a)
+    self.capacity = capacity
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    for k in self.fields:
+      state[k] = state[k][:self.count]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.Allocate(max(self.count, 1024))
+
+  def Emit(self, r, phi, vr, vphi):
+    r, phi, vr, vphi = [a.ravel() for a in numpy.broadcast_arrays(r, phi, vr, vphi)]
+    n = r.size
+    # Keep every k-th particle, k times larger. The phase carries over between
+    # calls, so this also thins out single particles.
+    k = 1 + 2 * (self.count + n) // self.budget
+    if k > 1:
+      keep = numpy.flatnonzero((self.phase + numpy.arange(n)) % k == 0)[:self.budget]
+      self.phase = (self.phase + n) % k
+      r, phi, vr, vphi = r[keep], phi[keep], vr[keep], vphi[keep]
+      n = len(keep)
+    if self.count + n > self.budget:
+      self.Cull(self.count + n - self.budget)
+    if self.count + n > self.capacity:
+      self.Allocate(max(2 * self.capacity, self.count + n))
+    s = slice(self.count, self.count + n)
+    self.r[s] = r
+    self.phi[s] = phi
+    self.vr[s] = vr
+    self.vphi[s] = vphi
+    self.age[s] = self.random.exponential(50, n)
+    self.last_r[s] = r
+    self.last_phi[s] = phi
+    self.weight[s] = k
+    self.count += n
+
+  def Cull(self, n):
+    # Removes the n oldest.
+    age = self.age[:self.count]
+    self.Remove(numpy.sort(numpy.argpartition(-age, n - 1)[:n]))
+
+  def Remove(self, dead):
+    # Fills the holes below the new end with the survivors above it.
+    k = self.count - len(dead)
+    alive = numpy.ones(self.count, bool)
+    alive[dead] = False
+    holes = dead[dead < k]
+    movers = numpy.flatnonzero(alive[k:]) + k
+    for name in self.fields:
+      a = getattr(self, name)
+      a[holes] = a[movers]
+    self.count = k
 
   def Update(self):
-    self.vr -= 0.02
-    self.vphi *= 0.99
-    self.vr *= 0.99
-    self.phi += self.vphi
-    self.r += self.vr
-    self.age += 1
-    if self.age >= 100:
-      game.objects.remove(self)
+    n = self.count
+    r, phi, vr, vphi, age, last_r, last_phi, weight = [getattr(self, k)[:n] for k in self.fields]
+    last_r[:] = r
+    last_phi[:] = phi
+    r[:], phi[:], vr[:], vphi[:] = Step(r, phi, vr, vphi)
+    age += 1
+    dead = numpy.flatnonzero(age >= 100)
+    if len(dead):
+      self.Remove(dead)
 
   def Render(self):
-    with Transform():
-      glRotate(self.phi, 0, 0, 1)
-      glTranslate(self.r, 0, 0)
-      with Texture(self.light):
-        with Blending(GL_ONE, GL_ONE):
-          f = 100.0 / (100 + self.age)
-          with Color(f, f * f, f * f * f):
-            Quad(200 * f, 200 * f)
+    if ParticleSystem.light is None:
+      ParticleSystem.light = Light(*PARTICLE_LIGHT)
+    n = self.count
+    self.drawn = 0
+    if not n:
+      return
+    r = Lerp(self.last_r[:n], self.r[:n])
+    a = Lerp(self.last_phi[:n], self.phi[:n]) * (math.pi / 180)
+    x = r * numpy.cos(a)
+    y = r * numpy.sin(a)
+    f = 100.0 / (100 + self.age[:n])
+    size = 200 * f * numpy.sqrt(self.weight[:n])
+    visible = numpy.flatnonzero((abs(x) < 0.5 * (WIDTH + size)) & (abs(y) < 0.5 * (HEIGHT + size)))
+    self.drawn = len(visible)
+    if not self.drawn:
+      return
+    f = f[visible]
+    color = numpy.column_stack([f, f * f, f * f * f])
+    game.queue.Submit(Sprites(x[visible], y[visible], size[visible], color), GL_QUADS, self.light, ADD, GLOW)
 
 
 def Explosion(r, phi, strength):
   x = r * math.cos(phi * math.pi / 180)
   y = r * math.sin(phi * math.pi / 180)
-  with Buffer(game.background):
-    glLoadIdentity()
-    with Transform():
-      glTranslate(x, y, 0)
-      with Color(0, 0, 0):
-        Circle(strength)
-    Circle(50)  # Moon core.
-  for i in range(strength):
-    t = random.random() * math.pi * 2
-    s = random.random() + 1
-    dx = s * math.cos(t)
-    dy = s * math.sin(t)
-    vr = Length(x + dx, y + dy) - Length(x, y)
-    vphi = math.atan2(y + dy, x + dx) * 180 / math.pi - phi
-    vphi %= 360
-    if vphi > 180:
-      vphi -= 360
-    game.objects.append(Particle(r, phi, vr, vphi))
-
-
-def MostFrequent(l):
-  l = sorted(l)
-  mc = c = 0
-  mf = lx = None
-  for x in l:
-    if x == lx:
-      c += 1
-    if c > mc:
-      mc = c
-      mf = lx
-    lx = x
-  return mf
+  game.surface.Circle(x, y, strength, 0)
+  game.surface.Circle(0, 0, 50, 255)
+  if game.background:
+    with Buffer(game.background):
+      glLoadIdentity()
+      with Transform():
+        glTranslate(x, y, 0)
+        with Color(0, 0, 0):
+          Circle(strength)
+      Circle(50)  # Moon core.
+  t = game.particles.random.uniform(0, math.pi * 2, strength)
+  s = game.particles.random.uniform(1, 2, strength)
+  ex = x + s * numpy.cos(t)
+  ey = y + s * numpy.sin(t)
+  vr = numpy.hypot(ex, ey) - Length(x, y)
+  vphi = (numpy.arctan2(ey, ex) * 180 / math.pi - phi) % 360
+  vphi[vphi > 180] -= 360
+  game.particles.Emit(r, phi, vr, vphi)
 
 
 class Taxi(object):
   light = None
 
-  def __init__(self):
-    self.phi = 90
-    self.r = 200
+  def __init__(self, r=200):
+    self.phi = self.last_phi = 90
+    self.r = self.last_r = r
     self.x = self.r * math.cos(self.phi * math.pi / 180)
     self.y = self.r * math.sin(self.phi * math.pi / 180)
     self.engine = 1
     self.shields = 0
     self.bombs = 0
     self.vphi = self.vr = 0
-    if Taxi.light == None:
-      Taxi.light = Light(20, 100, 50)
     self.passenger = None
     self.bonus = 0
     self.shop_timer = 0
 
   def Update(self):
-    pressed = pygame.key.get_pressed()
-    if pressed[pygame.K_LEFT] or pressed[pygame.K_RIGHT] or pressed[pygame.K_UP] or pressed[pygame.K_DOWN]:
-      SOUNDS['engine'].play()
+    self.last_r, self.last_phi = self.r, self.phi
+    keys = game.keys
+    if keys & THRUST:
+      game.Play('engine')
     else:
-      SOUNDS['engine'].stop()
-    if pressed[pygame.K_LEFT]:
-      game.objects.append(Particle(self.r, self.phi, self.vr, self.vphi - 100. / self.r))
+      game.Stop('engine')
+    if keys & LEFT:
+      game.particles.Emit(self.r, self.phi, self.vr, self.vphi - 100. / self.r)
       self.vphi += self.engine * 10. / self.r
-    if pressed[pygame.K_RIGHT]:
-      game.objects.append(Particle(self.r, self.phi, self.vr, self.vphi + 100. / self.r))
+    if keys & RIGHT:
+      game.particles.Emit(self.r, self.phi, self.vr, self.vphi + 100. / self.r)
       self.vphi -= self.engine * 10. / self.r
-    if pressed[pygame.K_DOWN]:
-      game.objects.append(Particle(self.r, self.phi, self.vr + 1, self.vphi))
+    if keys & DOWN:
+      game.particles.Emit(self.r, self.phi, self.vr + 1, self.vphi)
       self.vr -= self.engine * 0.1
-    if pressed[pygame.K_UP]:
-      game.objects.append(Particle(self.r, self.phi, self.vr - 1, self.vphi))
+    if keys & UP:
+      game.particles.Emit(self.r, self.phi, self.vr - 1, self.vphi)
       self.vr += self.engine * 0.1
-    self.vr -= 0.02
-    self.vphi *= 0.99
-    self.vr *= 0.99
-    self.phi += self.vphi
-    self.r += self.vr
+    self.r, self.phi, self.vr, self.vphi = Step(self.r, self.phi, self.vr, self.vphi)
     self.x = self.r * math.cos(self.phi * math.pi / 180)
     self.y = self.r * math.sin(self.phi * math.pi / 180)
     if self.bonus > 20.2:
       self.bonus -= 0.1
 
-    box = 20
-    pixels = ReadPixels(game.background, self.x * 2 + WIDTH - box / 2, self.y * 2 + HEIGHT - box / 2, box, box)
-    if any(c == '\xff' for c in pixels):
+    if game.surface.Touches(self.x, self.y, 10, 255):
       self.shields -= 1
       self.vphi *= -1
       self.vr *= -1
@@ -275,130 +721,132 @@ class Taxi(object):
         Explosion(self.r, self.phi, 50)
         if self.passenger:
           self.passenger = None
-          game.objects = [o for o in game.objects if not isinstance(o, Destination)]
-          game.Soon(lambda: game.Place(Guy))
-        game.objects.remove(self)
+          game.objects.RemoveAll(Destination)
+          game.Soon(functools.partial(game.Place, Guy))
+        game.objects.Remove(self)
+        game.crashes += 1
         game.Soon(game.NewTaxi)
         game.TakeMoney(PRICES['Crash'])
-        SOUNDS['crash'].play()
-        SOUNDS['engine'].stop()
+        game.Play('crash')
+        game.Stop('engine')
       else:
-        SOUNDS['shield-down'].play()
-    mf = MostFrequent([ord(p) for p in pixels if p != '\0'])
-    for k, v in SHOPS.items():
-      if mf == k[0]:
-        if v == 'Pay Debt' and game.debt <= 0:
-          self.shop_timer = 0
-          if game.debt_pos < 1:
-            game.debt_v = 1
-          break
-        if game.money < PRICES[v]:
-          self.shop_timer = 0
-          if game.money_pos < 1:
-            game.money_v = 1
-          break
-        self.shop_timer += 1
-        if self.shop_timer == SHOPPING_TIME:
-          game.TakeMoney(PRICES[v])
-          SOUNDS['buy'].play()
-          if v == 'Pay Debt':
-            game.debt_v += 1
-            game.debt -= PRICES[v]
-            if game.debt <= 0:
-              game.money -= game.debt
-              game.debt = 0
-              d = 1 if self.y < 0 else -1
-              Explosion(200, d * 90, 40)
+        game.Play('shield-down')
+    v = game.city.Shop(self.x, self.y, 5)
+    if v is None:
+      self.shop_timer = 0
+    elif v == 'Pay Debt' and game.debt <= 0:
+      self.shop_timer = 0
+      if game.debt_pos < 1:
+        game.debt_v = 1
+    elif game.money < PRICES[v]:
+      self.shop_timer = 0
+      if game.money_pos < 1:
+        game.money_v = 1
+    else:
+      self.shop_timer += 1
+      if self.shop_timer == SHOPPING_TIME:
+        game.TakeMoney(PRICES[v])
+        game.Play('buy')
+        if v == 'Pay Debt':
+          game.debt_v += 1
+          game.debt -= PRICES[v]
+          if game.debt <= 0:
+            game.money -= game.debt
+            game.debt = 0
+            d = 1 if self.y < 0 else -1
+            Explosion(200, d * 90, 40)
+            game.surface.Text(game.bigfont, 0, d * 200, 'Congratulations!', 255)
+            if game.background:
               with Buffer(game.background):
                 game.bigfont.Render(0, d * 200, 'Congratulations!', (1, 1, 1), 'center')
-              SOUNDS['win'].play()
-          elif v == 'Upgrade Engine':
-            self.engine += 1
-          elif v == 'Buy Shields':
-            self.shields += 1
-          elif v == 'Buy Bomb':
-            self.bombs += 1
-        break
-    else:
-      self.shop_timer = 0
+                game.queue.Flush()
+            game.Play('win')
+        elif v == 'Upgrade Engine':
+          self.engine += 1
+        elif v == 'Buy Shields':
+          self.shields += 1
+        elif v == 'Buy Bomb':
+          self.bombs += 1
 
   def Render(self):
-    with Transform():
-      glRotate(self.phi, 0, 0, 1)
-      glTranslate(self.r, 0, 0)
-      with Texture(self.light):
-        with Blending(GL_ONE, GL_ONE):
-          f = float(self.shop_timer) / SHOPPING_TIME if self.shop_timer < SHOPPING_TIME else 0
-          f = 0.8 * f
-          with Color(0.2 + 0.2 * f, 0.2 + 0.7 * f, 0.2 + f):
-            Quad(1024, 1024)
-      color = (1, 1, 1) if not self.passenger else (0.5, 1, 0.2)
-      for i in range(self.shields):
-        Ring(20 + i * 5)
-      with Color(*color):
-        glTranslate(-4, 0, 0)
-        Quad(8, 30)
-        glTranslate(8, 0, 0)
-        Quad(8, 16)
-      if self.bombs:
-        glTranslate(-8, -16, 0)
-        with Color(0, 0, 0):
-          for i in range(self.bombs):
-            glTranslate(0, 5, 0)
-            Circle(2)
+    if Taxi.light is None:
+      Taxi.light = Light(*TAXI_LIGHT)
+    phi = Lerp(self.last_phi, self.phi)
+    r = Lerp(self.last_r, self.r)
+    x = r * math.cos(phi * math.pi / 180)
+    y = r * math.sin(phi * math.pi / 180)
+    f = float(self.shop_timer) / SHOPPING_TIME if self.shop_timer < SHOPPING_TIME else 0
+    f = 0.8 * f
+    glow = 0.2 + 0.2 * f, 0.2 + 0.7 * f, 0.2 + f
+    game.queue.Submit(Vertices(Rect(1024, 1024, x, y), glow, QUAD_UV), GL_QUADS, self.light, ADD, GLOW)
+    for i in range(self.shields):
+      game.queue.Submit(Vertices(Place(RingLines(20 + i * 5), x, y, phi), (1, 1, 1)), GL_LINES)
+    color = (1, 1, 1) if not self.passenger else (0.5, 1, 0.2)
+    body = numpy.vstack([Rect(8, 30, -4, 0), Rect(8, 16, 4, 0)])
+    game.queue.Submit(Vertices(Place(body, x, y, phi), color), GL_QUADS)
+    if self.bombs:
+      bombs = numpy.vstack([Disc(2) + (-4, -16 + 5 * (i + 1)) for i in range(self.bombs)])
+      game.queue.Submit(Vertices(Place(bombs, x, y, phi), (0, 0, 0)))
+
+  def Preview(self):
+    # Where the taxi, or a bomb dropped now, would hit the surface without
+    # further thrust. The path up to the impact, and whether there is one.
+    r, phi = Trajectory(self.r, self.phi, self.vr, self.vphi, PREVIEW_TICKS)
+    a = phi * (math.pi / 180)
+    x = r * numpy.cos(a)
+    y = r * numpy.sin(a)
+    hits = numpy.flatnonzero(game.surface.Values(x, y))
+    if len(hits):
+      return x[:hits[0] + 1], y[:hits[0] + 1], True
+    return x, y, False
 
   def DropBomb(self):
     if self.bombs == 0:
       return
     self.bombs -= 1
-    game.objects.append(Bomb(self.r, self.phi, self.vr, self.vphi))
+    game.objects.Add(Bomb(self.r, self.phi, self.vr, self.vphi))
 
 
 class Bomb(object):
 
   def __init__(self, r, phi, vr, vphi):
-    self.r = r
-    self.phi = phi
+    self.r = self.last_r = r
+    self.phi = self.last_phi = phi
     self.vr = vr
     self.vphi = vphi
 
   def Update(self):
-    self.vr -= 0.02
-    self.vphi *= 0.99
-    self.vr *= 0.99
-    self.phi += self.vphi
-    self.r += self.vr
+    self.last_r, self.last_phi = self.r, self.phi
+    self.r, self.phi, self.vr, self.vphi = Step(self.r, self.phi, self.vr, self.vphi)
     self.x = self.r * math.cos(self.phi * math.pi / 180)
     self.y = self.r * math.sin(self.phi * math.pi / 180)
 
-    pixels = ReadPixels(game.background, self.x * 2 + WIDTH - 5, self.y * 2 + HEIGHT - 5, 10, 10)
-    if any(c != '\0' for c in pixels):
+    if game.surface.Solid(self.x, self.y, 5):
       Explosion(self.r, self.phi, 40)
-      game.objects.remove(self)
-      SOUNDS['crash'].play()
+      game.objects.Remove(self)
+      game.Play('crash')
 
   def Render(self):
-    with Transform():
-      glRotate(self.phi, 0, 0, 1)
-      glTranslate(self.r, 0, 0)
-      with Color(1.0, 0.7, 0.2):
-        Circle(5)
+    phi = Lerp(self.last_phi, self.phi) * math.pi / 180
+    r = Lerp(self.last_r, self.r)
+    game.queue.Submit(Vertices(Disc(5) + (r * math.cos(phi), r * math.sin(phi)), (1.0, 0.7, 0.2)))
 
 
 class Popup(object):
   dist = 10
 
   def __init__(self, x, y, phi):
-    self.x = x
-    self.y = y
+    self.x = self.last_x = x
+    self.y = self.last_y = y
     self.tx = x + self.dist * math.cos(phi)
     self.ty = y + self.dist * math.sin(phi)
     self.phi = phi * 180 / math.pi
     self.vx = 0
     self.vy = 0
-    self.scale = 0
+    self.scale = self.last_scale = 0
 
   def Update(self):
+    self.last_x, self.last_y, self.last_scale = self.x, self.y, self.scale
     dx = self.tx - self.x
     dy = self.ty - self.y
     self.vx += 0.01 * dx
@@ -410,6 +858,9 @@ class Popup(object):
     d2 = dx * dx + dy * dy
     self.scale = 1.0 / (1.0 + 0.01 * d2)
 
+  def Placed(self, xy):
+    return Place(xy, Lerp(self.last_x, self.x), Lerp(self.last_y, self.y), self.phi, Lerp(self.last_scale, self.scale))
+
 
 class Guy(Popup):
 
@@ -424,21 +875,15 @@ class Guy(Popup):
         self.x += dx / d
         self.y += dy / d
         if d < 5:
-          game.objects.remove(self)
+          game.objects.Remove(self)
           game.taxi.passenger = self
           game.Place(Destination)
           game.taxi.bonus = 100
-          SOUNDS['pickup'].play()
+          game.Play('pickup')
 
   def Render(self):
-    with Transform():
-      glTranslate(self.x, self.y, 0)
-      glRotate(self.phi, 0, 0, 1)
-      glScale(self.scale, self.scale, 1)
-      with Color(0.5, 1, 0.2):
-        Quad(15, 10)
-        glTranslate(15, 0, 0)
-        Circle(5)
+    game.queue.Submit(Vertices(self.Placed(Rect(15, 10)), (0.5, 1, 0.2)), GL_QUADS)
+    game.queue.Submit(Vertices(self.Placed(Disc(5) + (15, 0)), (0.5, 1, 0.2)))
 
 
 class Destination(Popup):
@@ -455,22 +900,16 @@ class Destination(Popup):
         self.x += dx / d
         self.y += dy / d
         if d < 5:
-          game.objects.remove(self)
+          game.objects.Remove(self)
           game.taxi.passenger = None
           game.Place(Building)
-          game.Soon(lambda: game.Place(Guy))
+          game.Soon(functools.partial(game.Place, Guy))
           game.GiveMoney(int(game.taxi.bonus))
           game.taxi.bonus = 0
-          SOUNDS['thanks'].play()
+          game.Play('thanks')
 
   def Render(self):
-    with Transform():
-      glTranslate(self.x, self.y, 0)
-      glRotate(self.phi, 0, 0, 1)
-      glScale(self.scale, self.scale, 1)
-      with Color(1, 0.7, 0.2):
-        glRotate(45, 0, 0, 1)
-        Quad(10, 10)
+    game.queue.Submit(Vertices(self.Placed(Place(Rect(10, 10), 0, 0, 45)), (1, 0.7, 0.2)), GL_QUADS)
 
 SHOPS = {
   (50, 179, 255): 'Upgrade Engine',
@@ -478,110 +917,905 @@ SHOPS = {
   (52, 179, 255): 'Buy Shields',
   (53, 179, 255): 'Buy Bomb',
 }
-
-SHOP_ORDER = SHOPS.keys()
-random.shuffle(SHOP_ORDER)
+# The value each shop's pixels have on the surface.
+SHOP_VALUE = dict((shop, color[0]) for color, shop in SHOPS.items())
 
 
 class Building(Popup):
-  last_shop = 0
 
   def __init__(self, x, y, phi):
     super(Building, self).__init__(x, y, phi)
     self.w = 20 + max(0, random.gauss(20, 20))
     self.h = 40 + max(0, random.gauss(40, 40))
     self.color = 255, 255, 255
-    Building.last_shop += 1
-    if Building.last_shop > 1 and random.random() < 0.2 or Building.last_shop > 3:
-      Building.last_shop = 0
-      self.color = SHOP_ORDER.pop(0)
-      SHOP_ORDER.append(self.color)
+    game.last_shop += 1
+    if game.last_shop > 1 and random.random() < 0.2 or game.last_shop > 3:
+      game.last_shop = 0
+      self.color = game.shop_order.pop(0)
+      game.shop_order.append(self.color)
       self.w = max(self.w, 80)
       self.h = max(self.h, 80)
 
   def Update(self):
     super(Building, self).Update()
     if Length(self.tx - self.x, self.ty - self.y) < 1:
+      self.Bake()
+      game.objects.Remove(self)
+
+  def Bake(self):
+    # Becomes part of the surface.
+    lot = Lot(self.x, self.y, self.phi - 90, self.w * self.scale, self.h * self.scale, SHOPS.get(self.color))
+    game.surface.Quad(lot.x, lot.y, lot.angle, lot.w, lot.h, self.color[0])
+    game.city.Add(lot)
+    if game.background:
       with Buffer(game.background):
         self.Render()
-      game.objects.remove(self)
+        game.queue.Flush()
 
   def Render(self):
-    with Transform():
-      glTranslate(self.x, self.y, 0)
-      glRotate(self.phi - 90, 0, 0, 1)
-      glScale(self.scale, self.scale, 1)
-      with Color([c / 255. for c in self.color]):
-        Quad(self.w, self.h)
-      if self.color in SHOPS:
-        text = SHOPS[self.color]
-        text += ' $%d' % PRICES[text]
-        words = text.split()
-        for i, w in enumerate(words):
-          game.smallfont.Render(0, (len(words) * 0.5 - 0.5 - i) * 20, w, (0.1, 0.1, 0.1), 'center')
+    place = lambda xy: self.Placed(Place(xy, 0, 0, -90))
+    game.queue.Submit(Vertices(place(Rect(self.w, self.h)), [c / 255. for c in self.color]), GL_QUADS)
+    if self.color in SHOPS:
+      Sign(SHOPS[self.color], place)
+
 
+def Sign(shop, place):
+  text = shop + ' $%d' % PRICES[shop]
+  words = text.split()
+  for i, w in enumerate(words):
+    game.smallfont.Render(0, (len(words) * 0.5 - 0.5 - i) * 20, w, (0.1, 0.1, 0.1), 'center', place)
 
+
+# The footprint of a baked building.
+class Lot(object):
+
+  def __init__(self, x, y, angle, w, h, shop):
+    self.x = x
+    self.y = y
+    self.angle = angle
+    self.w = w
+    self.h = h
+    self.shop = shop
+    a = angle * math.pi / 180
+    self.cos = math.cos(a)
+    self.sin = math.sin(a)
+    # Half extents of the bounding box.
+    self.ex = 0.5 * (abs(self.cos * w) + abs(self.sin * h))
+    self.ey = 0.5 * (abs(self.sin * w) + abs(self.cos * h))
+
+  def Contains(self, x, y, margin):
+    dx = x - self.x
+    dy = y - self.y
+    return abs(self.cos * dx + self.sin * dy) <= 0.5 * self.w + margin and abs(self.cos * dy - self.sin * dx) <= 0.5 * self.h + margin
+
+
+# Baked buildings in a spatial hash, so the taxi can find the shop under it
+# without looking at pixel colors.
+class City(object):
+  cell = 64
+  margin = 10
+
+  def __init__(self):
+    self.lots = []
+    self.cells = collections.defaultdict(list)
+
+  def Add(self, lot):
+    self.lots.append(lot)
+    c = self.cell
+    ex = lot.ex + self.margin
+    ey = lot.ey + self.margin
+    for i in range(int(math.floor((lot.x - ex) / c)), int(math.floor((lot.x + ex) / c)) + 1):
+      for j in range(int(math.floor((lot.y - ey) / c)), int(math.floor((lot.y + ey) / c)) + 1):
+        self.cells[i, j].append(lot)
+
+  def At(self, x, y, margin=0):
+    # The topmost lot at (x, y). Lots are filed with enough room around them
+    # for margins up to City.margin.
+    key = int(math.floor(x / self.cell)), int(math.floor(y / self.cell))
+    for lot in reversed(self.cells.get(key, ())):
+      if lot.Contains(x, y, margin):
+        return lot
+    return None
+
+  def Shop(self, x, y, margin):
+    # Only while some of the shop's own pixels are left near (x, y).
+    lot = self.At(x, y, margin)
+    if lot and lot.shop and game.surface.Touches(x, y, 2 * margin, SHOP_VALUE[lot.shop]):
+      return lot.shop
+    return None
+
+
+# Rasterizes the printable ASCII glyphs once into a texture atlas and draws
+# strings as quads from it. Recent string layouts are kept in a small LRU.
 class Font(object):
+  chars = ''.join(chr(i) for i in range(32, 127))
+  atlas_width = 512
+  layouts = 256
 
   def __init__(self, size):
     self.font = pygame.font.Font('OpenSans-ExtraBold.ttf', size)
-    self.cache = {}
-
-  def Render(self, x, y, text, color, align):
-    if text not in self.cache:
-      surface = self.font.render(text, True, (255, 255, 255), (0, 0, 0))
-      data = pygame.image.tostring(surface, 'RGBA', 1)
-      tex = glGenTextures(1)
-      width = surface.get_width()
-      height = surface.get_height()
-      glBindTexture(GL_TEXTURE_2D, tex)
-      glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-      glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-      glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
-      glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
-      glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, data)
-      if len(self.cache) > 200:
-        self.DropCache()
-      self.cache[text] = width, height, tex
-    width, height, tex = self.cache[text]
-    with Transform():
-      if align == 'left':
-        glTranslate(x + width / 2, y, 0)
-      elif align == 'right':
-        glTranslate(x - width / 2, y, 0)
-      elif align == 'center':
-        glTranslate(x, y, 0)
+    self.height = self.font.get_height()
+    surfaces = [self.font.render(c, True, (255, 255, 255), (0, 0, 0)) for c in self.chars]
+    # Pack the glyphs into rows.
+    places = []
+    x = y = 0
+    for g in surfaces:
+      if x + g.get_width() > self.atlas_width:
+        x = 0
+        y += self.height + 1
+      places.append((x, y))
+      x += g.get_width() + 1
+    atlas_height = y + self.height
+    atlas = pygame.Surface((self.atlas_width, atlas_height))
+    atlas.fill((0, 0, 0))
+    self.glyphs = {}
+    for c, g, (x, y) in zip(self.chars, surfaces, places):
+      atlas.blit(g, (x, y))
+      w, h = g.get_size()
+      # Texture rows are stored bottom-up.
+      u0, u1 = float(x) / self.atlas_width, float(x + w) / self.atlas_width
+      v0, v1 = float(atlas_height - y - h) / atlas_height, float(atlas_height - y) / atlas_height
+      self.glyphs[c] = w, h, (u0, v0, u1, v1)
+    data = pygame.image.tostring(atlas, 'RGB', 1)
+    self.atlas = numpy.fromstring(data, numpy.uint8).reshape(atlas_height, self.atlas_width, 3)[:, :, 0].copy()
+    self.texture = None
+    self.cache = collections.OrderedDict()
+
+  def Upload(self):
+    self.texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, self.texture)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+    glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    h, w = self.atlas.shape
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, w, h, 0, GL_LUMINANCE, GL_UNSIGNED_BYTE, self.atlas)
+
+  def Layout(self, text):
+    if text in self.cache:
+      layout = self.cache.pop(text)
+    else:
+      vertices = numpy.empty((len(text), 4, 2), numpy.float32)
+      uvs = numpy.empty((len(text), 4, 2), numpy.float32)
+      x = 0
+      for i, c in enumerate(text):
+        w, h, (u0, v0, u1, v1) = self.glyphs.get(c) or self.glyphs['?']
+        vertices[i] = (x, -0.5 * h), (x + w, -0.5 * h), (x + w, 0.5 * h), (x, 0.5 * h)
+        uvs[i] = (u0, v0), (u1, v0), (u1, v1), (u0, v1)
+        x += w
+      layout = vertices, uvs, x
+      if len(self.cache) >= self.layouts:
+        self.cache.popitem(last=False)
+    self.cache[text] = layout
+    return layout
+
+  def Render(self, x, y, text, color, align, place=None):
+    if self.texture is None:
+      self.Upload()
+    vertices, uvs, width = self.Layout(text)
+    if align == 'left':
+      xy = vertices.reshape(-1, 2) + (x, y)
+    elif align == 'right':
+      xy = vertices.reshape(-1, 2) + (x - width, y)
+    elif align == 'center':
+      xy = vertices.reshape(-1, 2) + (x - 0.5 * width, y)
+    else:
+      assert False, align
+    if place:
+      xy = place(xy)
+    uvs = uvs.reshape(-1, 2)
+    # Darken the background under the glyphs, then add the color.
+    game.queue.Submit(Vertices(xy, (1, 1, 1), uvs), GL_QUADS, self.texture, DARKEN, TEXT)
+    game.queue.Submit(Vertices(xy, color, uvs), GL_QUADS, self.texture, ADD, TEXT)
+
+  def Mask(self, text):
+    surface = self.font.render(text, True, (255, 255, 255), (0, 0, 0))
+    data = pygame.image.tostring(surface, 'RGBA', 1)
+    return numpy.fromstring(data, numpy.uint8).reshape(surface.get_height(), surface.get_width(), 4)[:, :, 0]
+
+
+def LoadFonts():
+  pygame.font.init()
+  return Font(12), Font(16), Font(20)
+
+
+# Sound effects are asked for during the ticks and played once per frame, so
+# a sound asked for many times in a frame plays once. Looping sounds have
+# channels of their own, started and stopped only when they change state. The
+# rest share a fixed pool of channels.
+class Mixer(object):
+
+  def __init__(self, pool=6):
+    self.sounds = {}
+    self.pool = pool
+    self.channels = []
+    self.priorities = []
+    self.loops = {}
+    self.wanted = {}
+    self.playing = {}
+    self.events = set()
+    self.position = 0
+
+  def Open(self):
+    # Called when the sounds are loaded. Reserving every channel keeps
+    # Sound.play() from taking them behind our back.
+    loops = [k for k in LOOPING if k in self.sounds]
+    pygame.mixer.set_num_channels(len(loops) + self.pool)
+    pygame.mixer.set_reserved(len(loops) + self.pool)
+    self.loops = dict((k, pygame.mixer.Channel(i)) for i, k in enumerate(loops))
+    self.wanted = dict((k, False) for k in loops)
+    self.playing = dict(self.wanted)
+    self.channels = [pygame.mixer.Channel(len(loops) + i) for i in range(self.pool)]
+    self.priorities = [0] * self.pool
+
+  def Play(self, sound):
+    if sound in self.loops:
+      self.wanted[sound] = True
+    elif sound in self.sounds:
+      self.events.add(sound)
+
+  def Stop(self, sound):
+    if sound in self.loops:
+      self.wanted[sound] = False
+    else:
+      self.events.discard(sound)
+
+  def Dispatch(self):
+    for sound, channel in self.loops.iteritems():
+      if self.wanted[sound] != self.playing[sound]:
+        self.playing[sound] = self.wanted[sound]
+        if self.wanted[sound]:
+          channel.play(self.sounds[sound], -1)
+        else:
+          channel.stop()
+    for sound in sorted(self.events, key=PRIORITY.get, reverse=True):
+      free = [i for i, c in enumerate(self.channels) if not c.get_busy()]
+      if free:
+        i = free[0]
       else:
-        assert False, align
-      with Texture(tex):
-        with Blending(GL_ZERO, GL_ONE_MINUS_SRC_COLOR):
-          Quad(width, height)
-        with Blending(GL_ONE, GL_ONE):
-          with Color(*color):
-            Quad(width, height)
+        i = min(range(self.pool), key=self.priorities.__getitem__)
+        if self.priorities[i] >= PRIORITY[sound]:
+          continue
+      self.channels[i].play(self.sounds[sound])
+      self.priorities[i] = PRIORITY[sound]
+    self.events.clear()
+    self.Music()
+
+  def Music(self):
+    # The next track is loaded on a thread while the current one plays, and
+    # SDL_mixer switches over to it by itself. Only the first track, or one
+    # whose successor was not ready in time, starts here.
+    position = pygame.mixer.music.get_pos()
+    if not pygame.mixer.music.get_busy():
+      pygame.mixer.music.load(self.NextTrack())
+      pygame.mixer.music.set_volume(0.5)
+      pygame.mixer.music.play()
+      position = pygame.mixer.music.get_pos()
+      self.Preload()
+    elif position < self.position:
+      self.Preload()
+    self.position = position
+
+  def Preload(self):
+    thread = threading.Thread(target=pygame.mixer.music.queue, args=(self.NextTrack(),))
+    thread.daemon = True
+    thread.start()
+
+  def NextTrack(self):
+    m = MUSIC.pop()
+    MUSIC.insert(0, m)
+    return m
+
+
+# Runs asset loading jobs on a thread pool. Each result is passed to its
+# callback on the main thread as soon as it arrives, so the callback can
+# upload it to GL.
+class Loader(object):
+
+  def __init__(self, threads=4):
+    self.pool = multiprocessing.pool.ThreadPool(threads)
+    self.results = Queue.Queue()
+    self.jobs = 0
+
+  def Add(self, name, load, done):
+    def Job():
+      try:
+        self.results.put((name, load(), done, None))
+      except Exception:
+        self.results.put((name, None, done, sys.exc_info()))
+    self.pool.apply_async(Job)
+    self.jobs += 1
+
+  def Finish(self, progress=None):
+    for i in range(self.jobs):
+      name, value, done, error = self.results.get()
+      if error:
+        raise error[0], error[1], error[2]
+      done(value)
+      if progress:
+        progress(i + 1, self.jobs, name)
+    self.pool.close()
+
+
+class Keyboard(object):
+
+  def Poll(self, game):
+    keys = 0
+    for e in pygame.event.get():
+      if e.type == pygame.KEYDOWN and e.key == pygame.K_SPACE:
+        keys |= BOMB
+      if e.type == pygame.QUIT or e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
+        keys |= QUIT
+    pressed = pygame.key.get_pressed()
+    for key, bit in (pygame.K_LEFT, LEFT), (pygame.K_RIGHT, RIGHT), (pygame.K_UP, UP), (pygame.K_DOWN, DOWN):
+      if pressed[key]:
+        keys |= bit
+    return keys
+
+
+# Mashes random key combinations, but does not climb out of the screen. Has its
+# own generator so it does not change what the game draws from random.
+class RandomPilot(object):
+
+  def __init__(self, seed=None):
+    self.random = random.Random(seed)
+    self.keys = 0
+    self.hold = 0
+
+  def Poll(self, game):
+    if self.hold == 0:
+      self.keys = self.random.choice([0, UP, UP | LEFT, UP | RIGHT, LEFT, RIGHT, DOWN])
+      self.hold = self.random.randint(5, 60)
+      if self.random.random() < 0.05:
+        self.keys |= BOMB
+    else:
+      self.keys &= ~BOMB
+    self.hold -= 1
+    if game.taxi.r > HEIGHT / 2 - 50:
+      return self.keys & ~UP
+    return self.keys
+
+
+def Grow(cells):
+  # Adds the 8 neighbors on a polar grid. Sectors wrap around, rings do not.
+  grown = cells | numpy.roll(cells, 1, 1) | numpy.roll(cells, -1, 1)
+  out = grown.copy()
+  out[1:] |= grown[:-1]
+  out[:-1] |= grown[1:]
+  return out
+
+
+# Steps to the goal cell over the free cells, found by a breadth-first
+# wavefront. The wavefront only advances as far as it is asked to, so the
+# work can be spread over ticks.
+class Wavefront(object):
+
+  def __init__(self, free, goal):
+    self.free = free.copy()
+    self.free[goal] = True
+    self.dist = numpy.empty(free.shape, int)
+    self.dist.fill(-1)
+    self.dist[goal] = 0
+    self.front = self.dist == 0
+    self.steps = 0
+
+  def Reach(self, cell, budget):
+    # Advances until the cell is reached, for at most budget steps. Returns
+    # the distance of the cell, or -1.
+    while self.dist[cell] < 0 and budget and self.front.any():
+      self.steps += 1
+      self.front = Grow(self.front) & self.free & (self.dist < 0)
+      self.dist[self.front] = self.steps
+      budget -= 1
+    return self.dist[cell]
+
+
+# Flies the taxi to the waiting guy, then to the destination. Plans on a polar
+# grid around the Moon. The free cells are sampled from the surface, and the
+# distances to the goal come from a Wavefront. Both are cached until the
+# surface or the goal cell changes, and the Wavefront advances a limited
+# number of steps per tick, so planning stays well under a millisecond.
+class Autopilot(object):
+  rings = 50
+  sectors = 120
+  ring = 10  # Pixels.
+  sector = 360. / sectors  # Degrees.
+
+  def __init__(self, budget=8):
+    self.budget = budget  # Wavefront steps per tick.
+    self.samples = None
+    self.version = None
+    self.free = None
+    self.fields = {}
+
+  def Occupancy(self, surface):
+    # A cell is free if no sample in it or in its neighbors is solid.
+    if self.samples is None:
+      sub = (numpy.arange(3) + 0.5) / 3
+      r = ((numpy.arange(self.rings)[:, numpy.newaxis] + sub) * self.ring).reshape(self.rings, 1, 3, 1)
+      phi = ((numpy.arange(self.sectors)[:, numpy.newaxis] + sub) * (self.sector * math.pi / 180)).reshape(1, self.sectors, 1, 3)
+      self.samples = surface.Indices(r * numpy.cos(phi), r * numpy.sin(phi))
+    index, inside = self.samples
+    solid = (surface.grid.ravel()[index] != 0) & inside
+    return ~Grow(solid.any(axis=(2, 3)))
+
+  def Cell(self, r, phi):
+    return min(int(r / self.ring), self.rings - 1), int(phi % 360 / self.sector) % self.sectors
+
+  def Goal(self, game):
+    target = Destination if game.taxi.passenger else Guy
+    for o in game.objects.Of(target):
+      return Length(o.x, o.y), math.atan2(o.y, o.x) * 180 / math.pi
+
+  def Poll(self, game):
+    if game.background and Keyboard().Poll(game) & QUIT:
+      return QUIT
+    taxi = game.taxi
+    if taxi not in game.objects:
+      return 0
+    goal = self.Goal(game)
+    if goal is None:
+      return self.Steer(taxi, taxi.r, taxi.phi)
+    if self.version != game.surface.version:
+      self.version = game.surface.version
+      self.free = self.Occupancy(game.surface)
+      self.fields = {}
+    cell = self.Cell(*goal)
+    if cell not in self.fields:
+      self.fields[cell] = Wavefront(self.free, cell)
+    field = self.fields[cell]
+    i, j = self.Cell(taxi.r, taxi.phi)
+    d = field.Reach((i, j), self.budget)
+    if d < 0:
+      # Not planned that far yet, or cut off. Hover meanwhile.
+      return self.Steer(taxi, taxi.r + (0 if field.front.any() else self.ring), taxi.phi)
+    if d <= 1:
+      return self.Steer(taxi, *goal)
+    # Head for the neighbor closest to the goal.
+    dist = field.dist
+    best = None
+    for di in -1, 0, 1:
+      for dj in -1, 0, 1:
+        n = i + di, (j + dj) % self.sectors
+        if 0 <= n[0] < self.rings and 0 <= dist[n] < d and (best is None or dist[n] < dist[best]):
+          best = n
+    return self.Steer(taxi, (best[0] + 0.5) * self.ring, (best[1] + 0.5) * self.sector)
+
+  def Steer(self, taxi, r, phi):
+    # Thrusts towards a velocity that points at the waypoint and shrinks as
+    # it gets close.
+    dphi = (phi - taxi.phi + 180) % 360 - 180
+    vr = max(-1, min(1, 0.05 * (r - taxi.r)))
+    arc = max(-1.5, min(1.5, 0.05 * dphi * math.pi / 180 * taxi.r))
+    vphi = arc / max(taxi.r, 1) * 180 / math.pi
+    keys = 0
+    coast_r, coast_phi, coast_vr, coast_vphi = Step(taxi.r, taxi.phi, taxi.vr, taxi.vphi)
+    if coast_vr < vr - 0.05 * taxi.engine:
+      keys |= UP
+    elif coast_vr > vr + 0.05 * taxi.engine:
+      keys |= DOWN
+    tolerance = 5. * taxi.engine / max(taxi.r, 1)
+    if coast_vphi < vphi - tolerance:
+      keys |= LEFT
+    elif coast_vphi > vphi + tolerance:
+      keys |= RIGHT
+    return keys
+
+
+# Wraps another input source and logs its output for every tick. The file is
+# a header with the random seed, then a zlib stream of one key byte per tick.
+class Recorder(object):
+  header = '<4sBI'
+  magic = 'STXR'
+  version = 2
+
+  def __init__(self, controls, filename, seed):
+    self.controls = controls
+    self.file = open(filename, 'wb')
+    self.file.write(struct.pack(self.header, self.magic, self.version, seed))
+    self.zip = zlib.compressobj(9)
+
+  def Poll(self, game):
+    keys = self.controls.Poll(game)
+    self.file.write(self.zip.compress(chr(keys)))
+    return keys
+
+  def Close(self):
+    self.file.write(self.zip.flush())
+    self.file.close()
+
+
+class Replay(object):
+
+  def __init__(self, filename):
+    with open(filename, 'rb') as f:
+      data = f.read()
+    magic, version, self.seed = struct.unpack_from(Recorder.header, data)
+    if magic != Recorder.magic or version != Recorder.version:
+      raise ValueError('%s is not a recording' % filename)
+    # Also works on a log that was cut short.
+    self.keys = zlib.decompressobj().decompress(data[struct.calcsize(Recorder.header):])
+    self.tick = 0
+
+  def Poll(self, game):
+    if game.background and Keyboard().Poll(game) & QUIT:
+      return QUIT
+    if self.tick >= len(self.keys):
+      return QUIT
+    self.tick += 1
+    return ord(self.keys[self.tick - 1])
+
+
+# The objects in the world, in a pool per type. Adding and removing only
+# take effect on Flush, so the pools can be iterated while they change.
+# Removal swaps the last object of the pool into the gap. Both are applied in
+# the order they were asked for, so the pools end up in the same order on
+# every run.
+class Objects(object):
+  # Update and render order.
+  types = ParticleSystem, Building, Guy, Destination, Bomb, Taxi
+
+  def __init__(self):
+    self.pools = dict((t, []) for t in self.types)
+    self.ordered = [self.pools[t] for t in self.types]
+    self.index = {}
+    self.added = collections.OrderedDict()
+    self.removed = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self.index) + len(self.added) - len(self.removed)
+
+  def __contains__(self, o):
+    return (o in self.index or o in self.added) and o not in self.removed
+
+  def __iter__(self):
+    for pool in self.ordered:
+      for o in pool:
+        if o not in self.removed:
+          yield o
+
+  def Of(self, t):
+    return [o for o in self.pools[t] if o not in self.removed]
+
+  def Add(self, o):
+    self.added[o] = None
+
+  def Remove(self, o):
+    if o in self.added:
+      del self.added[o]
+    elif o in self.index:
+      self.removed[o] = None
+
+  def RemoveAll(self, t):
+    for o in self.pools[t]:
+      self.removed[o] = None
+    for o in self.added.keys():
+      if type(o) is t:
+        del self.added[o]
+
+  def Flush(self):
+    if not self.removed and not self.added:
+      return
+    for o in self.removed:
+      pool = self.pools[type(o)]
+      i = self.index.pop(o)
+      last = pool.pop()
+      if last is not o:
+        pool[i] = last
+        self.index[last] = i
+    self.removed.clear()
+    for o in self.added:
+      pool = self.pools[type(o)]
+      self.index[o] = len(pool)
+      pool.append(o)
+    self.added.clear()
+
+
+class Timer(object):
+
+  def __init__(self, time, f, period):
+    self.time = time
+    self.f = f
+    self.period = period
+    self.cancelled = False
+
+  def Cancel(self):
+    self.cancelled = True
+
+
+# Pending timers in a heap. The sequence number keeps timers that are due at
+# the same time in the order they were added. Cancelled timers stay in the
+# heap until they come up.
+class Scheduler(object):
 
-  def DropCache(self):
-    for w, h, tex in self.cache.values():
-      glDeleteTextures(tex)
-    self.cache = {}
+  def __init__(self):
+    self.heap = []
+    self.seq = 0
+
+  def __len__(self):
+    return len(self.heap)
+
+  def Add(self, time, f, period=None):
+    timer = Timer(time, f, period)
+    self.Push(timer)
+    return timer
+
+  def Push(self, timer):
+    heapq.heappush(self.heap, (timer.time, self.seq, timer))
+    self.seq += 1
+
+  def Run(self, now):
+    while self.heap and self.heap[0][0] <= now:
+      timer = heapq.heappop(self.heap)[2]
+      if timer.cancelled:
+        continue
+      timer.f()
+      if timer.period and not timer.cancelled:
+        timer.time += timer.period
+        self.Push(timer)
+
+
+class Nothing(object):
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    pass
+
+NOTHING = Nothing()
+
+
+class Section(object):
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc):
+    t = self.profiler.frame
+    t[self.name] = t.get(self.name, 0) + time.time() - self.start
+
+
+# Times the phases of each frame. Keeps a rolling window of samples for
+# percentiles, and optionally writes every frame as a line of JSON.
+class Profiler(object):
+
+  def __init__(self, window=600, trace=None, overlay=False):
+    self.window = window
+    self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+    self.sections = {}
+    self.frame = {}
+    self.counters = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+    self.counts = {}
+    self.frames = 0
+    self.last = time.time()
+    self.trace = open(trace, 'w') if trace else None
+    self.overlay = overlay
+    self.lines = []
+
+  def Section(self, name):
+    if name not in self.sections:
+      self.sections[name] = Section(self, name)
+    return self.sections[name]
+
+  def Count(self, name, value):
+    self.counts[name] = value
+
+  def EndFrame(self):
+    now = time.time()
+    self.frame['frame'] = now - self.last
+    self.last = now
+    for k in self.samples:
+      if k not in self.frame:
+        self.samples[k].append(0)
+    for k, v in self.frame.iteritems():
+      self.samples[k].append(v)
+    for k, v in self.counts.iteritems():
+      self.counters[k].append(v)
+    if self.trace:
+      line = {'frame': self.frames, 'ms': dict((k, v * 1000) for k, v in self.frame.iteritems())}
+      if self.counts:
+        line['counts'] = self.counts
+      self.trace.write(json.dumps(line) + '\n')
+    self.frame = {}
+    self.counts = {}
+    self.frames += 1
+
+  def Percentiles(self):
+    # Milliseconds at p50, p95 and p99 for each section.
+    return dict((k, tuple(numpy.percentile(v, [50, 95, 99]) * 1000)) for k, v in self.samples.iteritems() if v)
+
+  def Report(self):
+    lines = []
+    for k, (p50, p95, p99) in sorted(self.Percentiles().items()):
+      lines.append('%-24s %7.2f %7.2f %7.2f' % (k, p50, p95, p99))
+    lines = ['%-24s %7s %7s %7s' % ('ms', 'p50', 'p95', 'p99')] + lines
+    for k, v in sorted(self.counters.iteritems()):
+      lines.append('%-24s %7d %7d %7d' % ((k,) + tuple(numpy.percentile(v, [50, 95, 99]))))
+    return lines
+
+  def Overlay(self, font):
+    if self.frames % 30 == 0:
+      self.lines = self.Report()
+    for i, line in enumerate(self.lines):
+      font.Render(-WIDTH / 2 + 20, HEIGHT / 2 - 60 - i * 14, line, (0.8, 0.8, 0.8), 'left')
+
+  def Close(self):
+    if self.trace:
+      self.trace.close()
+
+
+# Keeps the particle budget where the average frame takes about the target
+# time. Backs off quickly when frames are slow and grows back slowly.
+class ParticleBudget(object):
+
+  def __init__(self, target, least=256, most=PARTICLE_BUDGET, smoothing=0.05):
+    self.target = target
+    self.least = least
+    self.most = most
+    self.smoothing = smoothing
+    self.average = 0
+
+  def Update(self, budget, frame):
+    self.average += (frame - self.average) * self.smoothing
+    if self.average > self.target:
+      return max(self.least, int(budget * 0.98))
+    if self.average < 0.8 * self.target:
+      return min(self.most, budget + 16)
+    return budget
+
+
+# Picks the background buffer scale from the frame times. Steps down a scale
+# when the average frame takes longer than the budget, and back up when it
+# takes well under. Waits a while after each change for the average to settle.
+class DynamicScale(object):
+
+  def __init__(self, scale, budget, low=0.6, high=0.9, smoothing=0.05, cooldown=120):
+    self.scales = [s for s in BUFFER_SCALES if s <= scale]
+    self.index = len(self.scales) - 1
+    self.budget = budget
+    self.low = low
+    self.high = high
+    self.smoothing = smoothing
+    self.cooldown = cooldown
+    self.average = 0
+    self.wait = cooldown
+
+  def Update(self, frame):
+    self.average += (frame - self.average) * self.smoothing
+    if self.wait:
+      self.wait -= 1
+    elif self.average > self.high * self.budget and self.index > 0:
+      self.index -= 1
+      self.wait = self.cooldown
+    elif self.average < self.low * self.budget and self.index < len(self.scales) - 1:
+      self.index += 1
+      self.wait = self.cooldown
+    return self.scales[self.index]
+
+
+def ReduceMethod(m):
+  return getattr, (m.im_self, m.im_func.__name__)
+
+# Timers hold bound methods of Game. This lets them be saved.
+copy_reg.pickle(types.MethodType, ReduceMethod)
+
+
+def WriteSave(filename, data):
+  data = struct.pack(SAVE_HEADER, SAVE_MAGIC, SAVE_VERSION) + zlib.compress(data, 6)
+  with open(filename + '.tmp', 'wb') as f:
+    f.write(data)
+  if os.path.exists(filename):
+    os.remove(filename)
+  os.rename(filename + '.tmp', filename)
+
+
+def Load(filename, headless=False, controls=None, profiler=None):
+  global game
+  with open(filename, 'rb') as f:
+    data = f.read()
+  magic, version = struct.unpack_from(SAVE_HEADER, data)
+  if magic != SAVE_MAGIC or version != SAVE_VERSION:
+    raise ValueError('%s is not a saved game' % filename)
+  state = cPickle.loads(zlib.decompress(data[struct.calcsize(SAVE_HEADER):]))
+  random.setstate(state['random'])
+  numpy.random.set_state(state['numpy'])
+  game = state['game']
+  game.Attach(headless, controls, profiler)
+  return game
+
+SAVE_HEADER = '<4sB'
+SAVE_MAGIC = 'STXS'
+SAVE_VERSION = 5
 
 
 class Game(object):
-
-  def __init__(self):
-    self.timers = []
+  # Attributes that belong to this process rather than to the world.
+  runtime = ('headless', 'controls', 'profiler', 'alpha', 'background', 'bg_tex', 'mixer',
+             'smallfont', 'font', 'bigfont', 'autosave', 'saving', 'queue',
+             'buffer_scale', 'dynamic_scale', 'particle_budget')
+
+  def __init__(self, headless=False, controls=None, seed=None, profiler=None):
+    self.seed = random.randrange(2 ** 32) if seed is None else seed
+    random.seed(self.seed)
+    numpy.random.seed(self.seed)
+    self.shop_order = sorted(SHOPS)
+    random.shuffle(self.shop_order)
+    self.last_shop = 0
+    self.timers = Scheduler()
     self.time = 0
-    self.objects = []
+    self.keys = 0
+    self.objects = Objects()
     self.money = 0
     self.debt = 1000
+    self.crashes = 0
     self.debt_pos = 30
     self.debt_v = 0
     self.money_pos = 30
     self.money_v = 0
     self.show_hud = False
+    self.surface = Surface()
+    self.surface.Circle(0, 0, 100, 255)
+    self.city = City()
+    self.particles = ParticleSystem(seed=self.seed)
+    self.objects.Add(self.particles)
+    self.Attach(headless, controls, profiler)
+    self.NewTaxi(330)
+    self.taxi.shields = 1
+    self.Soon(self.Intro, delay=120)
+    self.objects.Flush()
+
+  def Attach(self, headless, controls, profiler):
+    self.headless = headless
+    self.controls = controls or (RandomPilot(self.seed) if headless else Keyboard())
+    self.profiler = profiler
+    self.alpha = 1.0
+    self.background = None
+    self.mixer = Mixer()
+    self.autosave = None
+    self.saving = None
+    self.queue = RenderQueue()
+    self.buffer_scale = 2
+    self.dynamic_scale = None
+    self.particle_budget = None
+    if headless:
+      self.UseFonts(LoadFonts())
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    for k in self.runtime:
+      state.pop(k, None)
+    return state
+
+  def Snapshot(self):
+    return cPickle.dumps({'game': self, 'random': random.getstate(), 'numpy': numpy.random.get_state()}, 2)
+
+  def Save(self, filename):
+    WriteSave(filename, self.Snapshot())
+
+  def Autosave(self):
+    # Only the snapshot is taken on this thread. Compressing and writing it
+    # happen in the background.
+    if self.saving and self.saving.is_alive():
+      return
+    self.saving = threading.Thread(target=WriteSave, args=(self.autosave, self.Snapshot()))
+    self.saving.start()
 
-  def Loop(self):
+  def OpenWindow(self):
     pygame.init()
+    # Decoding and rasterizing happen in the background while the window and
+    # the GL context come up.
+    loader = Loader()
+    loader.Add('fonts', LoadFonts, self.UseFonts)
+    for k, v in SOUNDS.items():
+      loader.Add(v, functools.partial(pygame.mixer.Sound, v), functools.partial(self.mixer.sounds.__setitem__, k))
+    for light in PARTICLE_LIGHT, TAXI_LIGHT:
+      loader.Add('light', lambda light=light: numpy.array(LightData(*light)), functools.partial(Light, *light))
     pygame.display.gl_set_attribute(pygame.GL_MULTISAMPLEBUFFERS, 1)
     pygame.display.gl_set_attribute(pygame.GL_MULTISAMPLESAMPLES, 4)
     pygame.display.set_caption('Satellite Taxi')
@@ -591,112 +1825,226 @@ class Game(object):
     glLoadIdentity()
     glScale(2./WIDTH, 2./HEIGHT, 1)
     glMatrixMode(GL_MODELVIEW)
-    bg_tex = glGenTextures(1)
-    glBindTexture(GL_TEXTURE_2D, bg_tex)
+    self.bg_tex = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, self.bg_tex)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_FALSE)
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, WIDTH * 2, HEIGHT * 2, 0, GL_RGB, GL_UNSIGNED_BYTE, None)
     self.background = glGenFramebuffers(1)
+    glBindFramebuffer(GL_FRAMEBUFFER, self.background)
+    glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.bg_tex, 0)
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    loader.Finish(self.Progress)
+    self.BuildBackground()
+    self.mixer.sounds['engine'].set_volume(0.2)
+    self.mixer.Open()
+
+  def BuildBackground(self):
+    # The background is rebuilt from the surface in one upload. This works for
+    # a loaded game and after a change of the buffer scale too.
+    width = int(WIDTH * self.buffer_scale)
+    height = int(HEIGHT * self.buffer_scale)
+    glBindTexture(GL_TEXTURE_2D, self.bg_tex)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, width, height, 0, GL_RGB, GL_UNSIGNED_BYTE, self.surface.Image(width, height))
+    # Shop signs are not part of the surface.
     with Buffer(self.background):
-      glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, bg_tex, 0)
-      glClear(GL_COLOR_BUFFER_BIT)
-      Circle(100)
-    clock = pygame.time.Clock()
-    self.NewTaxi()
-    self.taxi.r = 330
-    self.taxi.shields = 1
-    self.Soon(self.Intro, delay=120)
-    pygame.font.init()
-    self.smallfont = Font(12)
-    self.font = Font(16)
-    self.bigfont = Font(20)
-    for k, v in SOUNDS.items():
-      SOUNDS[k] = pygame.mixer.Sound(v)
-    SOUNDS['engine'].set_volume(0.2)
+      glLoadIdentity()
+      for lot in self.city.lots:
+        if lot.shop:
+          Sign(lot.shop, functools.partial(Place, x=lot.x, y=lot.y, angle=lot.angle))
+      self.queue.Flush()
+
+  def SetBufferScale(self, scale):
+    self.buffer_scale = scale
+    if self.background:
+      self.BuildBackground()
+
+  def UseFonts(self, fonts):
+    self.smallfont, self.font, self.bigfont = fonts
+    if self.background:
+      for f in fonts:
+        f.Upload()
+
+  def Progress(self, done, total, name):
+    glClear(GL_COLOR_BUFFER_BIT)
+    glLoadIdentity()
+    w = 0.5 * WIDTH * done / total
+    glTranslate(0.5 * (w - 0.5 * WIDTH), 0, 0)
+    Quad(w, 4)
+    glLoadIdentity()
+    pygame.display.flip()
 
+  def Loop(self, fps=240):
+    start = time.time()
+    self.OpenWindow()
+    clock = pygame.time.Clock()
+    first = True
+    behind = 0
     while True:
-      clock.tick(60)
-      self.time += 1
-      if not pygame.mixer.music.get_busy():
-        m = MUSIC.pop()
-        pygame.mixer.music.load(m)
-        pygame.mixer.music.set_volume(0.5)
-        pygame.mixer.music.play()
-        MUSIC.insert(0, m)
-      while self.timers and self.timers[0][0] == self.time:
-        t, f = self.timers.pop(0)
-        f()
-      for e in pygame.event.get():
-        if e.type == pygame.KEYDOWN and e.key == pygame.K_SPACE:
-          if self.taxi in self.objects:
-            self.taxi.DropBomb()
-        if e.type == pygame.QUIT or e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
+      with self.Section('wait'):
+        behind += clock.tick(fps) / 1000.
+      work = time.time()
+      ticks = 0
+      while behind >= TICK and ticks < MAX_TICKS:
+        if not self.Tick():
           print 'fps:', clock.get_fps()
           pygame.quit()
-          sys.exit(0)
-      for o in self.objects[:]:
+          return
+        behind -= TICK
+        ticks += 1
+      if ticks == MAX_TICKS:
+        # Too slow to catch up. Let the game slow down instead.
+        behind = min(behind, TICK)
+      with self.Section('audio'):
+        self.mixer.Dispatch()
+      self.alpha = behind / TICK
+      self.Render()
+      if self.dynamic_scale or self.particle_budget:
+        # The GPU work counts towards the frame, but with vsync flip also
+        # waits for the display, and that wait must not look like load.
+        with self.Section('finish'):
+          glFinish()
+      busy = time.time() - work
+      with self.Section('flip'):
+        pygame.display.flip()
+      if self.dynamic_scale:
+        scale = self.dynamic_scale.Update(busy)
+        if scale != self.buffer_scale:
+          self.SetBufferScale(scale)
+      if self.particle_budget:
+        self.particles.budget = self.particle_budget.Update(self.particles.budget, busy)
+      if self.profiler:
+        self.profiler.Count('buffer scale %', int(self.buffer_scale * 100))
+        self.profiler.Count('particle budget', self.particles.budget)
+      if first:
+        print 'first frame after %.0f ms' % ((time.time() - start) * 1000)
+        first = False
+      if self.profiler:
+        self.profiler.EndFrame()
+
+  def Run(self, ticks):
+    # Simulation only, as fast as possible.
+    for i in xrange(ticks):
+      if not self.Tick():
+        break
+      if self.profiler:
+        self.profiler.EndFrame()
+
+  def Tick(self):
+    with self.Section('events'):
+      self.keys = self.controls.Poll(self)
+    if self.keys & QUIT:
+      return False
+    self.time += 1
+    self.alpha = 1.0
+    with self.Section('timers'):
+      self.timers.Run(self.time)
+    self.objects.Flush()
+    if self.keys & BOMB and self.taxi in self.objects:
+      self.taxi.DropBomb()
+    if self.profiler:
+      for t, pool in zip(self.objects.types, self.objects.ordered):
+        if pool:
+          with self.profiler.Section('Update.' + t.__name__):
+            for o in pool:
+              if o not in self.objects.removed:
+                o.Update()
+    else:
+      for o in self.objects:
         o.Update()
-      glClear(GL_COLOR_BUFFER_BIT)
-      glLoadIdentity()
-      with Texture(bg_tex):
-        Quad(WIDTH, HEIGHT)
+    self.objects.Flush()
+    if self.show_hud:
+      self.Animate()
+    if self.autosave and self.time % AUTOSAVE_TICKS == 0:
+      self.Autosave()
+    return True
+
+  def Render(self):
+    glClear(GL_COLOR_BUFFER_BIT)
+    glLoadIdentity()
+    self.queue.Submit(Vertices(Rect(WIDTH, HEIGHT), (1, 1, 1), QUAD_UV), GL_QUADS, self.bg_tex, OPAQUE, BACKGROUND)
+    if self.profiler:
+      for t, pool in zip(self.objects.types, self.objects.ordered):
+        if pool:
+          with self.profiler.Section('Render.' + t.__name__):
+            for o in pool:
+              o.Render()
+    else:
       for o in self.objects:
         o.Render()
+    with self.Section('HUD'):
       self.HUD()
-      pygame.display.flip()
-
-  def HUD(self):
-    if not self.show_hud:
-      return
+      if self.profiler and self.profiler.overlay:
+        self.profiler.Overlay(self.smallfont)
+    with self.Section('draw'):
+      self.queue.Flush()
+    if self.profiler:
+      self.profiler.Count('draw calls', self.queue.draws)
+      self.profiler.Count('state changes', self.queue.changes)
+      self.profiler.Count('particles', self.particles.count)
+      self.profiler.Count('particles drawn', self.particles.drawn)
+
+  def Section(self, name):
+    return self.profiler.Section(name) if self.profiler else NOTHING
+
+  def Play(self, sound):
+    self.mixer.Play(sound)
+
+  def Stop(self, sound):
+    self.mixer.Stop(sound)
+
+  def Animate(self):
     self.debt_v -= 0.05 * self.debt_pos
     self.debt_v *= 0.85
     self.debt_pos += self.debt_v
     self.money_v -= 0.05 * self.money_pos
     self.money_v *= 0.85
     self.money_pos += self.money_v
+
+  def HUD(self):
+    if not self.show_hud:
+      return
     self.font.Render(-WIDTH / 2 + 20, HEIGHT / 2 - 20 + self.debt_pos, 'DEBT:', (1.0, 1.0, 1.0), 'left')
     self.bigfont.Render(-WIDTH / 2 + 130, HEIGHT / 2 - 20 + self.debt_pos, str(self.debt), (1.0, 0.7, 0.2), 'right')
     self.font.Render(WIDTH / 2 - 130, HEIGHT / 2 - 20 + self.money_pos, 'CASH:', (1.0, 1.0, 1.0), 'left')
     self.bigfont.Render(WIDTH / 2 - 20, HEIGHT / 2 - 20 + self.money_pos, str(self.money), (0.5, 1.0, 0.2), 'right')
     if self.taxi.bonus:
       self.font.Render(WIDTH / 2 - 20, HEIGHT / 2 - 40, '+%d' % self.taxi.bonus, (0.5, 1.0, 0.2), 'right')
+    if self.taxi in self.objects:
+      with self.Section('preview'):
+        self.Preview()
+
+  def Preview(self):
+    x, y, hit = self.taxi.Preview()
+    color = (1.0, 0.7, 0.2) if self.taxi.bombs else (0.4, 0.4, 0.4)
+    dots = numpy.column_stack([x[9::10], y[9::10]])
+    if len(dots):
+      self.queue.Submit(Vertices((Disc(1)[numpy.newaxis] + dots[:, numpy.newaxis]).reshape(-1, 2), color))
+    if hit:
+      self.queue.Submit(Vertices(RingLines(8) + (x[-1], y[-1]), color), GL_LINES)
 
   def Intro(self):
     self.show_hud = True
-    self.Soon(lambda: self.Place(Guy))
+    self.Soon(functools.partial(self.Place, Guy))
 
   def Place(self, cls):
-    p = ReadPixels(self.background, 0, 0, WIDTH * 2, HEIGHT * 2)
-    def Free(x, y):
-      return p[int(x) * 2 + int(y) * 4 * WIDTH] == '\0'
-    full = []
-    for x in range(0, WIDTH, 10):
-      for y in range(0, HEIGHT, 10):
-        if Length(game.taxi.x - x + WIDTH / 2, game.taxi.y - y + HEIGHT / 2) < 100:
-          continue
-        if not Free(x, y):
-          full.append((x, y))
-    random.shuffle(full)
-    for x, y in full:
-      phi = math.atan2(y - HEIGHT / 2, x - WIDTH / 2)
-      r = Length(y - HEIGHT / 2, x - WIDTH / 2)
-      fx = (r + 10) * math.cos(phi) + WIDTH / 2
-      fy = (r + 10) * math.sin(phi) + HEIGHT / 2
-      if Free(fx, fy):
-        o = cls(float(x - WIDTH / 2), float(y - HEIGHT / 2), phi)
-        self.objects.append(o)
-        break
+    p = self.surface.frontier.Pick(self.taxi.x, self.taxi.y, 100)
+    if p:
+      x, y = p
+      self.objects.Add(cls(float(x), float(y), math.atan2(y, x)))
 
   def Soon(self, f, delay=50):
-    self.timers.append((self.time + delay, f))
-    self.timers.sort()
+    return self.timers.Add(self.time + delay, f)
+
+  def Every(self, f, period):
+    return self.timers.Add(self.time + period, f, period)
 
-  def NewTaxi(self):
-    self.taxi = Taxi()
-    self.objects.append(self.taxi)
+  def NewTaxi(self, r=200):
+    self.taxi = Taxi(r)
+    self.objects.Add(self.taxi)
 
   def GiveMoney(self, m):
     game.money += m
@@ -714,6 +2062,70 @@ class Game(object):
       game.money = 0
 
 
+def Main():
+  global game
+  parser = argparse.ArgumentParser(description='Satellite Taxi')
+  parser.add_argument('--headless', action='store_true', help='simulate without window, rendering or audio')
+  parser.add_argument('--ticks', type=int, default=100000, help='ticks to simulate in headless mode')
+  parser.add_argument('--fps', type=int, default=240, help='frame rate limit, 0 for none')
+  parser.add_argument('--seed', type=int, help='random seed')
+  parser.add_argument('--record', metavar='FILE', help='record the input of this session')
+  parser.add_argument('--replay', metavar='FILE', help='play back a recorded session')
+  parser.add_argument('--autopilot', action='store_true', help='let the taxi fly itself')
+  parser.add_argument('--profile', action='store_true', help='time each phase of the frame')
+  parser.add_argument('--overlay', action='store_true', help='show frame timings on screen')
+  parser.add_argument('--trace', metavar='FILE', help='write frame timings as JSON lines')
+  parser.add_argument('--load', metavar='FILE', help='continue a saved game')
+  parser.add_argument('--save', metavar='FILE', help='save the game on exit')
+  parser.add_argument('--autosave', metavar='FILE', help='save the game every minute')
+  parser.add_argument('--buffer-scale', type=float, default=2, choices=BUFFER_SCALES, help='background resolution relative to the window')
+  parser.add_argument('--particle-target', type=float, metavar='MS', help='shrink the particle budget when the work of a frame takes longer than this (waits for the GPU every frame)')
+  parser.add_argument('--dynamic-scale', type=float, metavar='MS', help='lower the background resolution when frames take longer than this')
+  args = parser.parse_args()
+  if args.load and (args.record or args.replay):
+    parser.error('recordings always start from a new game')
+  profiler = None
+  if args.profile or args.overlay or args.trace:
+    profiler = Profiler(trace=args.trace, overlay=args.overlay)
+  seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+  controls = RandomPilot(seed) if args.headless else Keyboard()
+  if args.autopilot:
+    controls = Autopilot()
+  if args.replay:
+    controls = Replay(args.replay)
+    seed = controls.seed
+  if args.record:
+    controls = Recorder(controls, args.record, seed)
+  if args.load:
+    game = Load(args.load, headless=args.headless, controls=controls, profiler=profiler)
+  else:
+    game = Game(headless=args.headless, controls=controls, seed=seed, profiler=profiler)
+  game.autosave = args.autosave
+  game.buffer_scale = args.buffer_scale
+  if args.particle_target and not args.headless:
+    game.particle_budget = ParticleBudget(args.particle_target / 1000.)
+  if args.dynamic_scale:
+    game.dynamic_scale = DynamicScale(args.buffer_scale, args.dynamic_scale / 1000.)
+  if args.headless:
+    t = time.time()
+    ticks = game.time
+    game.Run(args.ticks)
+    t = time.time() - t
+    print '%d ticks in %.2f s (%.0f ticks/s), %d objects' % (game.time - ticks, t, (game.time - ticks) / t, len(game.objects))
+  else:
+    game.Loop(args.fps)
+  if args.record:
+    controls.Close()
+  if args.save:
+    game.Save(args.save)
+  if game.saving:
+    game.saving.join()
+  if profiler:
+    print '\n'.join(profiler.Report())
+    profiler.Close()
+
+
 if __name__ == '__main__':
-  game = Game()
-  game.Loop()
+  # Run from the module, so saved games refer to run_game and not __main__.
+  import run_game
+  run_game.Main()
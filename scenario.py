@@ -0,0 +1,81 @@
+import argparse
+import math
+import numpy
+import time
+import run_game
+
+# Populations of a generated world, by name.
+DEFAULTS = [
+  ('buildings', 1000),
+  ('craters', 40),
+  ('particles', 10000),
+  ('bombs', 50),
+  ('popups', 40),
+]
+
+
+def Build(game):
+  # A building placed like Game.Place and baked like Building.Update does
+  # once it has finished popping up.
+  p = game.surface.frontier.Pick(game.taxi.x, game.taxi.y, 100)
+  if not p:
+    return False
+  x, y = p
+  b = run_game.Building(float(x), float(y), math.atan2(y, x))
+  b.x, b.y, b.scale = b.tx, b.ty, 1.0
+  b.Bake()
+  return True
+
+
+def Clear(game):
+  # Lifts the taxi out of the city if the city grew over it.
+  taxi = game.taxi
+  while game.surface.Solid(taxi.x, taxi.y, 20):
+    taxi.r = taxi.last_r = taxi.r + 10
+    taxi.x = taxi.r * math.cos(taxi.phi * math.pi / 180)
+    taxi.y = taxi.r * math.sin(taxi.phi * math.pi / 180)
+
+
+def Populate(game, buildings=1000, craters=40, particles=10000, bombs=50, popups=40):
+  # Everything is drawn from the game's seed, so the same arguments always
+  # give the same world.
+  random = numpy.random.RandomState(game.seed)
+  for i in range(buildings):
+    if not Build(game):
+      break
+  lots = game.city.lots
+  for i in range(craters if lots else 0):
+    lot = lots[random.randint(len(lots))]
+    r = run_game.Length(lot.x, lot.y)
+    phi = math.atan2(lot.y, lot.x) * 180 / math.pi
+    run_game.Explosion(r, phi, int(random.uniform(20, 60)))
+  game.particles.budget = max(game.particles.budget, 4 * particles)  # Room for all of them without merging.
+  game.particles.Emit(
+    random.uniform(100, 500, particles), random.uniform(0, 360, particles),
+    random.normal(0, 0.5, particles), random.normal(0, 0.2, particles))
+  # Falling from different heights, the bombs keep exploding for a while.
+  for i in range(bombs):
+    game.objects.Add(run_game.Bomb(random.uniform(400, 1500), random.uniform(0, 360), 0, random.normal(0, 0.2)))
+  for i in range(popups):
+    game.Place(run_game.Guy if i % 2 else run_game.Destination)
+  Clear(game)
+  game.objects.Flush()
+
+
+def Generate(seed=1, **populations):
+  game = run_game.game = run_game.Game(headless=True, seed=seed)
+  Populate(game, **populations)
+  return game
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generates a crowded saved game for profiling. Play it with run_game.py --load.')
+  parser.add_argument('output', help='saved game file')
+  parser.add_argument('--seed', type=int, default=1)
+  for name, default in DEFAULTS:
+    parser.add_argument('--' + name, type=int, default=default, help='default: %d' % default)
+  args = parser.parse_args()
+  t = time.time()
+  game = Generate(args.seed, **dict((name, getattr(args, name)) for name, default in DEFAULTS))
+  game.Save(args.output)
+  print '%d lots, %d objects, %d particles in %.2f s' % (len(game.city.lots), len(game.objects), game.particles.count, time.time() - t)